@@ -6,6 +6,9 @@ import os
 import dotenv
 from flask import Flask
 
+import jobs
+import metrics
+
 dotenv.load_dotenv()
 _dash_renderer._set_react_version("18.2.0")
 
@@ -18,10 +21,12 @@ app = dash.Dash(
     title='T-Investments',
     use_pages=True,
     pages_folder='pages',
-    external_stylesheets=dmc.styles.ALL
+    external_stylesheets=dmc.styles.ALL,
+    background_callback_manager=jobs.manager
 )
 
 server.config.update(SECRET_KEY=os.getenv("SECRET_KEY"))
+metrics.init_app(server, app)
 
 if __name__ == '__main__':
     server.run(debug=True,port=9662,use_reloader=True, host = "0.0.0.0")
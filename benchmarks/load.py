@@ -0,0 +1,100 @@
+#Нагрузочный тест страницы аналитики: users одновременных пользователей выбирают акции и интервалы и двигают ползунок.
+#Ответы API по умолчанию воспроизводятся из записи (INVEST_TRANSPORT=replay, каталог INVEST_REPLAY_DIR),
+#задержка вызовов API задается INVEST_REPLAY_LATENCY и INVEST_REPLAY_JITTER (мс). Запись делается запуском приложения с INVEST_TRANSPORT=record.
+#
+#    INVEST_REPLAY_LATENCY=50 python benchmarks/load.py --users 20 --duration 60
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+
+os.environ.setdefault("INVEST_TRANSPORT", "replay")
+os.environ.setdefault("FLIGHT_RESULT_TTL", "30")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run
+import replay
+
+
+#Сценарий одного пользователя: открыть страницу, затем до окончания времени выбирать акцию и интервал и двигать ползунок
+def simulate_user(app, figis, intervals, slides, deadline, latencies, errors, lock):
+    callbacks = run.DashCallbacks(app.app, app.server)
+    analytics = sys.modules["pages.analytics"]
+
+    def call(name, values, triggered):
+        start = time.perf_counter()
+        try: response = callbacks.call(name, values, triggered)
+        except Exception as error:
+            with lock: errors.append(f"{name}: {error}")
+            return None
+        with lock: latencies.setdefault(name, []).append(time.perf_counter() - start)
+        return response
+
+    response = call("initial_callback", {"load_interval.n_intervals": 1}, "load_interval.n_intervals")
+    if response is None: return
+    session_id = response["session_id"]["data"]
+    while time.time() < deadline:
+        interval = random.choice(intervals)
+        response = call("update_chart_data", {
+            '{"index":"share","type":"select"}.value': random.choice(figis),
+            '{"index":"interval","type":"select"}.value': interval,
+            '{"index":"candle","type":"select"}.value': analytics.chart_props["standard_values"][interval]["candle"]["value"],
+            "vector_size.value": random.randint(1, 10),
+            "session_id.data": session_id,
+        }, '{"index":"share","type":"select"}.value')
+        if response is None: break
+
+        dataset_id = response["dataset_id"]["data"]
+        props = call("update_chart_props", {"dataset_id.data": dataset_id}, "dataset_id.data")
+        if props is None: continue
+
+        size = props["share_price_slider"]["max"] + 1
+        for _ in range(slides):
+            start = random.randint(0, max(size - 2, 0))
+            call("slider_change_processing", {
+                "dataset_id.data": dataset_id,
+                "vector_size.value": 1,
+                "share_price_slider.value": [start, random.randint(start + 1, max(size - 1, start + 1))],
+                '{"index":"vector_vals","type":"select"}.value': random.choice(["all", "positive", "negative"]),
+                '{"category":"dist_chart_props","index":["ALL"]}.checked': {"rm_outliers": False, "show_hist": True, "show_curve": True, "show_rug": True},
+            }, "share_price_slider.value")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Нагрузочный тест страницы аналитики на записанных ответах API")
+    parser.add_argument("--users", type = int, default = 10)
+    parser.add_argument("--duration", type = float, default = 30, help = "длительность теста в секундах")
+    parser.add_argument("--intervals", default = "1d,1w", help = "стандартные интервалы через запятую")
+    parser.add_argument("--slides", type = int, default = 5, help = "движений ползунка на один набор данных")
+    parser.add_argument("--figis", help = "акции через запятую (по умолчанию - все, для которых записаны свечи)")
+    args = parser.parse_args()
+
+    figis = args.figis.split(",") if args.figis else replay.replay_store.get_candle_figis()
+    if not figis: raise SystemExit(f"В {replay.REPLAY_DIR} нет записанных свечей")
+
+    #Первый запрос регистрирует обратные вызовы страниц до запуска потоков
+    import app
+    run.DashCallbacks(app.app, app.server)
+
+    latencies, errors, lock = {}, [], threading.Lock()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target = simulate_user, args = (app, figis, args.intervals.split(","), args.slides, deadline, latencies, errors, lock)) for _ in range(args.users)]
+    started = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{'callback':<28}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in latencies.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+        print(f"{name:<28}{len(values):>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{max(values) * 1000:>10.1f}")
+    print(f"Запросов: {sum(len(values) for values in latencies.values())} за {elapsed:.1f} с, ошибок: {len(errors)}")
+    for error in errors[:10]: print(error)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#Замеры производительности горячих путей functions.py и обратных вызовов страницы аналитики на синтетических данных.
+#API заменяется заглушкой с заготовленными свечами, локальное хранилище свечей создается во временном каталоге.
+#
+#    python benchmarks/run.py                               замер на размерах 1k-1M
+#    python benchmarks/run.py --save benchmarks/baseline.json
+#    python benchmarks/run.py --compare benchmarks/baseline.json --tolerance 0.25
+#
+#При сравнении с базовыми значениями код возврата 1, если какой-либо замер медленнее базового больше чем на tolerance,
+#и 2, если файла базовых значений нет или в нем нет ни одного замера текущего запуска.
+#benchmarks/baseline.json - базовые значения запуска с параметрами по умолчанию.
+import os
+import sys
+import re
+import json
+import time
+import argparse
+import platform
+import itertools
+import tempfile
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from tinkoff.invest import CandleInterval
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+os.chdir(ROOT)
+BENCHMARK_DIR = tempfile.mkdtemp(prefix = "benchmark_")
+os.environ["CANDLE_STORE_PATH"] = os.path.join(BENCHMARK_DIR, "candles.db")
+os.environ["DATASET_DISK_DIR"] = os.path.join(BENCHMARK_DIR, "datasets")
+os.environ["JOB_CACHE_DIR"] = os.path.join(BENCHMARK_DIR, "jobs")
+os.environ["METRICS_SPOOL_DIR"] = os.path.join(BENCHMARK_DIR, "metrics")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+#Повторные вызовы замеряют расчет набора данных, а не чтение готового результата
+os.environ.setdefault("FLIGHT_RESULT_TTL", "0")
+
+import functions
+import synthetic
+
+#Обратные вызовы замеряются на стандартных интервалах с минутными свечами
+callback_intervals = {"1d": timedelta(days = 1), "1w": timedelta(weeks = 1), "1m": timedelta(days = 31), "6m": timedelta(days = 184), "1y": timedelta(days = 366)}
+dist_chart_props = ["rm_outliers", "show_hist", "show_curve", "show_rug"]
+
+
+#Замер: лучшее время из repeat запусков и пиковая память отдельного запуска под tracemalloc
+def measure(case, size, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    seconds = min(timings)
+    return {"case": case, "size": size, "seconds": seconds, "throughput": size / seconds if seconds else None, "peak_mb": peak / 2 ** 20}
+
+
+#Вызов обратных вызовов Dash через HTTP-обработчик сервера (с сериализацией ответа и сессией в cookie).
+#Фоновые обратные вызовы опрашиваются по выданным сервером cacheKey и job до получения результата.
+class DashCallbacks():
+    def __init__(self, app, server, poll_interval = 0.05):
+        self.__client = server.test_client()
+        self.__poll_interval = poll_interval
+        page = self.__client.get("/analytics").get_data(as_text = True)
+        config = re.search(r'<script id="_dash-config" type="application/json">(.*?)</script>', page, re.S)
+        self.__end_id = json.loads(config.group(1)).get("end_id") if config else None
+        self.__callbacks = {entry["callback"].__name__: (output, entry) for output, entry in app.callback_map.items() if "callback" in entry}
+
+    @staticmethod
+    def __parse_id(id):
+        return json.loads(id) if id.startswith("{") else id
+
+    #Конкретные id для шаблона с ALL
+    @staticmethod
+    def __expand(id):
+        if id == '{"category":"dist_chart_props","index":["ALL"]}': return [{"category": "dist_chart_props", "index": index} for index in dist_chart_props]
+        if id == '{"index":["ALL"],"type":"nav_button"}': return [{"type": "nav_button", "index": index} for index in ["first", "prev", "next", "last", "refresh"]]
+        return None
+
+    def __spec(self, id, property, values):
+        ids = self.__expand(id)
+        if ids is None: return {"id": self.__parse_id(id), "property": property, "value": values.get(f"{id}.{property}")}
+        return [{"id": item, "property": property, "value": item if property == "id" else values.get(f"{id}.{property}", {}).get(item["index"])} for item in ids]
+
+    def call(self, name, values, triggered):
+        output, entry = self.__callbacks[name]
+        outputs = []
+        #У обратных вызовов без выходов вместо списка выходов служебный идентификатор
+        for item in output.strip(".").split("...") if not entry.get("no_output") else []:
+            id, property = item.rsplit(".", 1)
+            ids = self.__expand(id)
+            outputs.append({"id": self.__parse_id(id), "property": property} if ids is None else [{"id": item, "property": property} for item in ids])
+
+        body = {
+            "output": output,
+            "outputs": outputs,
+            "inputs": [self.__spec(item["id"], item["property"], values) for item in entry["inputs"]],
+            "state": [self.__spec(item["id"], item["property"], values) for item in entry["state"]],
+            "changedPropIds": [triggered],
+        }
+        query = {"endId": self.__end_id} if self.__end_id else {}
+        response = self.__client.post("/_dash-update-component", json = body, query_string = query)
+        while True:
+            if response.status_code == 204: return {}
+            if response.status_code != 200: raise RuntimeError(f"{name}: HTTP {response.status_code}")
+            data = response.get_json()
+            if "response" in data: return data["response"]
+            if "cacheKey" in data: query.update(cacheKey = data["cacheKey"], job = data["job"])
+            elif "cacheKey" not in query: raise RuntimeError(f"{name}: неожиданный ответ {data}")
+            time.sleep(self.__poll_interval)
+            response = self.__client.post("/_dash-update-component", json = body, query_string = query)
+
+
+#Замеры функций на свечах size
+def run_function_cases(size, max_objects, repeat):
+    candles_df = synthetic.generate_candles(size)
+    results = []
+
+    prices = list(candles_df["open"].values)
+    results.append(measure("math_round", size, lambda: [functions.math_round(price, 2) for price in prices], repeat))
+
+    if size <= max_objects:
+        historic_candles = synthetic.to_historic_candles(candles_df)
+        quotations = [candle.open for candle in historic_candles]
+        results.append(measure("quotation_to_float", size, lambda: [functions.quotation_to_float(quotation) for quotation in quotations], repeat))
+        results.append(measure("collect_candles", size, lambda: functions.columns_to_prices(functions.collect_candles(iter(historic_candles))[0]), repeat))
+
+        #Холодная загрузка: каждый запуск - новая акция, свечи идут через заглушку API в хранилище
+        functions.client_pool.close()
+        functions.Client = synthetic.stub_client(historic_candles, [])
+        end_datetime = datetime.fromtimestamp((candles_df.index[-1] + 60000) / 1000, pytz.UTC)
+        time_interval = timedelta(minutes = size)
+        figis = (f"COLD{size}_{index}" for index in itertools.count())
+        results.append(measure("get_candles_df_cold", size, lambda: functions.get_candles_df(next(figis), CandleInterval.CANDLE_INTERVAL_1_MIN, time_interval, end_datetime), repeat))
+        results.append(measure("get_candles_df_warm", size, lambda: functions.get_candles_df("COLD%d_0" % size, CandleInterval.CANDLE_INTERVAL_1_MIN, time_interval, end_datetime), repeat))
+        del historic_candles, quotations
+
+    results.append(measure("get_vectors", size, lambda: functions.get_vectors(candles_df, 5), repeat))
+
+    candles_df["vector"] = functions.get_vectors(candles_df, 5)
+    purchase_coef_limit = functions.get_purchase_coef_limit(candles_df["vector"].values)
+    results.append(measure("get_balance_history", size, lambda: functions.get_balance_history(candles_df, purchase_coef_limit, 0, 0.0003), repeat))
+    results.append(measure("remove_outliers", size, lambda: functions.remove_outliers(candles_df, "vector"), repeat))
+    results.append(measure("get_distribution", size, lambda: functions.get_distribution(candles_df["vector"].values, candles_df.index.values), repeat))
+
+    candles_df["balance"] = functions.get_balance_history(candles_df, purchase_coef_limit, 0, 0.0003)
+    results.append(measure("get_chart_data", size, lambda: functions.get_chart_data(candles_df), repeat))
+
+    return results
+
+#Замеры обратных вызовов страницы аналитики на стандартных интервалах, в которых не больше max_objects минутных свечей
+def run_callback_cases(max_objects, repeat):
+    intervals = {name: interval for name, interval in callback_intervals.items() if interval // timedelta(minutes = 1) <= max_objects}
+    if not intervals: return []
+
+    now = datetime.now(pytz.UTC)
+    candles_df = synthetic.generate_candles(max(interval // timedelta(minutes = 1) for interval in intervals.values()) + 1440)
+    shares = synthetic.get_stub_shares(1, now - timedelta(days = 3650))
+    functions.client_pool.close()
+    functions.Client = synthetic.stub_client(synthetic.to_historic_candles(candles_df), shares)
+
+    import app
+    callbacks = DashCallbacks(app.app, app.server)
+    session_id = callbacks.call("initial_callback", {"load_interval.n_intervals": 1}, "load_interval.n_intervals")["session_id"]["data"]
+
+    results = []
+    for name in intervals:
+        values = {
+            '{"index":"share","type":"select"}.value': shares[0].figi,
+            '{"index":"interval","type":"select"}.value': name,
+            '{"index":"candle","type":"select"}.value': "1m",
+            "vector_size.value": 5,
+            "session_id.data": session_id,
+        }
+        update = lambda: callbacks.call("update_chart_data", values, '{"index":"share","type":"select"}.value')
+        response = update()
+        size = callbacks.call("update_chart_props", {"dataset_id.data": response["dataset_id"]["data"]}, "dataset_id.data")["share_price_slider"]["max"] + 1
+        results.append(measure(f"update_chart_data[{name}]", size, update, repeat))
+
+        #Перетаскивание ползунка: каждый вызов - новое окно
+        response = update()
+        offsets = itertools.count()
+        slider_values = {
+            "dataset_id.data": response["dataset_id"]["data"],
+            "vector_size.value": 5,
+            '{"index":"vector_vals","type":"select"}.value': "all",
+            '{"category":"dist_chart_props","index":["ALL"]}.checked': {"rm_outliers": False, "show_hist": True, "show_curve": True, "show_rug": True},
+        }
+        def slide():
+            offset = next(offsets) % (size // 4)
+            return callbacks.call("slider_change_processing", {**slider_values, "share_price_slider.value": [offset, size - 1 - offset]}, "share_price_slider.value")
+        results.append(measure(f"slider_change_processing[{name}]", size, slide, repeat))
+
+    return results
+
+
+def print_results(results, baseline):
+    print(f"{'case':<36}{'size':>10}{'seconds':>12}{'items/s':>14}{'peak MB':>10}{'vs base':>10}")
+    for result in results:
+        base = baseline.get(f"{result['case']}/{result['size']}")
+        ratio = f"{result['seconds'] / base['seconds']:.2f}x" if base else ""
+        throughput = f"{result['throughput']:.0f}" if result["throughput"] else ""
+        print(f"{result['case']:<36}{result['size']:>10}{result['seconds']:>12.5f}{throughput:>14}{result['peak_mb']:>10.1f}{ratio:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Замеры производительности на синтетических свечах")
+    parser.add_argument("--sizes", default = "1000,10000,100000,1000000", help = "размеры рядов свечей через запятую")
+    parser.add_argument("--max-objects", type = int, default = 100000, help = "наибольший размер для замеров на объектах API (HistoricCandle, Quotation) и обратных вызовов")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--skip-callbacks", action = "store_true")
+    parser.add_argument("--save", help = "сохранить результаты как базовые значения (JSON)")
+    parser.add_argument("--compare", help = "сравнить с базовыми значениями (JSON)")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "допустимое относительное замедление")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        if not os.path.exists(args.compare): parser.error(f"нет файла базовых значений {args.compare} (создается через --save)")
+        with open(args.compare) as file: baseline = json.load(file)["results"]
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results += run_function_cases(size, args.max_objects, args.repeat)
+    if not args.skip_callbacks: results += run_callback_cases(args.max_objects, args.repeat)
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({
+                "created": datetime.now().isoformat(timespec = "seconds"),
+                "python": platform.python_version(),
+                "machine": platform.node(),
+                "results": {f"{result['case']}/{result['size']}": result for result in results},
+            }, file, indent = 2, ensure_ascii = False)
+
+    #Сравнение, в котором не нашлось ни одного общего замера, считается ошибкой, а не успехом
+    compared = [result for result in results if f"{result['case']}/{result['size']}" in baseline]
+    if args.compare and not compared:
+        print(f"Нет замеров, совпадающих с базовыми значениями {args.compare}: проверьте --sizes и --max-objects")
+        return 2
+
+    regressions = [
+        result for result in results
+        if f"{result['case']}/{result['size']}" in baseline and result["seconds"] > baseline[f"{result['case']}/{result['size']}"]["seconds"] * (1 + args.tolerance)
+    ]
+    for result in regressions: print(f"Замедление: {result['case']} ({result['size']})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import bisect
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from tinkoff.invest import HistoricCandle, Quotation
+
+
+#Синтетические свечи: геометрическое случайное блуждание с шагом interval_ms, последняя свеча начинается не позже end_ms.
+#Формат совпадает с functions.get_candles_df: индекс time (мс UTC), колонки open, close, high, low, volume.
+def generate_candles(size, interval_ms = 60000, end_ms = None, seed = 0, start_price = 100.0, volatility = 0.001):
+    rng = np.random.default_rng(seed)
+    if end_ms is None: end_ms = int(datetime.now(pytz.UTC).timestamp() * 1000)
+    end_ms -= end_ms % interval_ms
+    times = end_ms - np.arange(size - 1, -1, -1, dtype = np.int64) * interval_ms
+
+    closes = start_price * np.exp(np.cumsum(rng.normal(-volatility * volatility / 2, volatility, size)))
+    opens = np.concatenate(([start_price], closes[:-1]))
+    spread = np.abs(rng.normal(0, volatility, size)) * opens
+    candles_df = pd.DataFrame(
+        {
+            "open": np.round(opens, 2),
+            "close": np.round(closes, 2),
+            "high": np.round(np.maximum(opens, closes) + spread, 2),
+            "low": np.round(np.minimum(opens, closes) - spread, 2),
+            "volume": rng.integers(1, 1000, size),
+        },
+        index = pd.Index(times, name = "time")
+    )
+    return candles_df
+
+def to_quotation(price):
+    units = int(np.floor(price))
+    return Quotation(units = units, nano = int(round((price - units) * 10 ** 9)))
+
+#Перевести синтетические свечи в объекты HistoricCandle, которые возвращает API
+def to_historic_candles(candles_df):
+    return [
+        HistoricCandle(
+            open = to_quotation(open),
+            high = to_quotation(high),
+            low = to_quotation(low),
+            close = to_quotation(close),
+            volume = int(volume),
+            time = datetime.fromtimestamp(time / 1000, pytz.UTC),
+            is_complete = True,
+        )
+        for time, open, high, low, close, volume in zip(candles_df.index, candles_df["open"], candles_df["high"], candles_df["low"], candles_df["close"], candles_df["volume"])
+    ]
+
+
+#Акция с полями, которые используются приложением
+@dataclass
+class StubShare():
+    figi: str
+    ticker: str
+    name: str
+    first_1min_candle_date: datetime
+    buy_available_flag: bool = True
+    sell_available_flag: bool = True
+
+class StubResponse():
+    def __init__(self, **fields): self.__dict__.update(fields)
+
+class StubInstruments():
+    def __init__(self, shares):
+        self.__shares = shares
+
+    def shares(self):
+        return StubResponse(instruments = self.__shares)
+
+    def share_by(self, id_type = None, id = None, **kwargs):
+        return StubResponse(instrument = next(share for share in self.__shares if share.figi == id))
+
+#Сервисы API с заготовленными свечами: для любого figi и интервала отдаются свечи из [from_, to)
+class StubServices():
+    def __init__(self, candles, shares):
+        self.__candles = candles
+        self.__times = [int(candle.time.timestamp() * 1000) for candle in candles]
+        self.instruments = StubInstruments(shares)
+
+    def get_all_candles(self, figi = None, from_ = None, to = None, interval = None, **kwargs):
+        start = bisect.bisect_left(self.__times, int(from_.timestamp() * 1000))
+        end = bisect.bisect_left(self.__times, int(to.timestamp() * 1000))
+        return iter(self.__candles[start:end])
+
+#Получить класс клиента с интерфейсом tinkoff.invest.Client, отдающего заготовленные данные
+def stub_client(candles, shares):
+    class StubClient():
+        def __init__(self, token, target = None, **kwargs): pass
+        def __enter__(self): return StubServices(candles, shares)
+        def __exit__(self, *args): pass
+
+    return StubClient
+
+def get_stub_shares(count, first_candle_datetime):
+    return [StubShare(figi = f"BENCH{index:04d}", ticker = f"BN{index}", name = f"Benchmark {index}", first_1min_candle_date = first_candle_datetime) for index in range(count)]
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import itertools
+import threading
+
+import dotenv
+import numpy as np
+import pandas as pd
+
+dotenv.load_dotenv()
+STORE_PATH = os.getenv("CANDLE_STORE_PATH", "candles.db")
+
+
+#Локальное хранилище свечей (SQLite).
+#Свечи хранятся по ключу (figi, interval, time), где time - начало свечи в миллисекундах UTC.
+#В таблице ranges хранятся уже загруженные полуинтервалы [start, end), по ним вычисляются пропуски.
+class CandleStore():
+    def __init__(self, path):
+        self.__path = path
+        self.__connect()
+
+    #Соединение SQLite не переживает fork, поэтому в дочернем процессе (фоновые задачи) оно открывается заново
+    def __connect(self):
+        self.__pid = os.getpid()
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(self.__path, check_same_thread = False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS candles (
+                figi TEXT NOT NULL,
+                interval INTEGER NOT NULL,
+                time INTEGER NOT NULL,
+                open REAL NOT NULL,
+                high REAL NOT NULL,
+                low REAL NOT NULL,
+                close REAL NOT NULL,
+                volume INTEGER NOT NULL,
+                PRIMARY KEY (figi, interval, time)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS ranges (
+                figi TEXT NOT NULL,
+                interval INTEGER NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ranges_key ON ranges (figi, interval, start);
+        """)
+        self.__connection.commit()
+
+    def __check_process(self):
+        if self.__pid != os.getpid(): self.__connect()
+
+    #Получить незагруженные промежутки внутри [start, end)
+    def get_gaps(self, figi, interval, start, end):
+        self.__check_process()
+        start, end = int(start), int(end)
+        with self.__lock:
+            ranges = self.__connection.execute(
+                "SELECT start, end FROM ranges WHERE figi = ? AND interval = ? AND end > ? AND start < ? ORDER BY start",
+                (figi, int(interval), start, end)
+            ).fetchall()
+
+        gaps = []
+        position = start
+        for range_start, range_end in ranges:
+            if range_start > position: gaps.append((position, range_start))
+            position = max(position, range_end)
+        if position < end: gaps.append((position, end))
+
+        return gaps
+
+    #Сохранить свечи (колонки time, open, high, low, close, volume) и отметить промежуток [start, end) как загруженный
+    def put(self, figi, interval, candles, start, end):
+        self.__check_process()
+        start, end = int(start), int(end)
+        rows = zip(
+            itertools.repeat(figi),
+            itertools.repeat(int(interval)),
+            *[np.asarray(candles[column]).tolist() for column in ["time", "open", "high", "low", "close", "volume"]]
+        )
+        with self.__lock, self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO candles (figi, interval, time, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if start >= end: return
+
+            #Объединение с пересекающимися и соседними промежутками
+            overlapped = self.__connection.execute(
+                "SELECT MIN(start), MAX(end) FROM ranges WHERE figi = ? AND interval = ? AND end >= ? AND start <= ?",
+                (figi, int(interval), start, end)
+            ).fetchone()
+            if overlapped[0] is not None:
+                start = min(start, overlapped[0])
+                end = max(end, overlapped[1])
+            self.__connection.execute(
+                "DELETE FROM ranges WHERE figi = ? AND interval = ? AND end >= ? AND start <= ?",
+                (figi, int(interval), start, end)
+            )
+            self.__connection.execute("INSERT INTO ranges (figi, interval, start, end) VALUES (?, ?, ?, ?)", (figi, int(interval), start, end))
+
+    #Прочитать свечи из промежутка [start, end)
+    def load(self, figi, interval, start, end):
+        self.__check_process()
+        with self.__lock:
+            return pd.read_sql_query(
+                "SELECT time, open, high, low, close, volume FROM candles WHERE figi = ? AND interval = ? AND time >= ? AND time < ? ORDER BY time",
+                self.__connection,
+                params = (figi, int(interval), int(start), int(end))
+            )
+
+
+candle_store = CandleStore(STORE_PATH)
@@ -5,23 +5,75 @@ from dash.exceptions import PreventUpdate
 from pandas.api.types import is_datetime64tz_dtype
 
 import os
+import copy
 import pytz
 import json
+import time
+import atexit
+import threading
+import uuid
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 from dateutil import tz
 from dateutil.relativedelta import relativedelta
 from datetime import datetime
 
 import dotenv
+import psutil
+import diskcache
 import pandas as pd
 import numpy as np
 
-from tinkoff.invest import Client, InstrumentIdType
-from tinkoff.invest.constants import INVEST_GRPC_API_SANDBOX
+import grpc
+from tinkoff.invest import Client, InstrumentIdType, CandleInterval
+from tinkoff.invest.constants import INVEST_GRPC_API, INVEST_GRPC_API_SANDBOX
+from tinkoff.invest.exceptions import RequestError
 from tinkoff.invest.utils import now
 
+import replay
+import metrics
+from candle_store import candle_store
+
 dotenv.load_dotenv()
 TOKEN = os.getenv("INVEST_TOKEN")
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", 3600))
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", 2))
+DATASET_CACHE_SIZE = int(os.getenv("DATASET_CACHE_SIZE", 64))
+DATASET_DISK_DIR = os.getenv("DATASET_DISK_DIR", "datasets_cache")
+DATASET_DISK_LIMIT = int(os.getenv("DATASET_DISK_LIMIT", 2 ** 30))
+CHART_POINTS = int(os.getenv("CHART_POINTS", 1500))
+DISTRIBUTION_CACHE_SIZE = int(os.getenv("DISTRIBUTION_CACHE_SIZE", 128))
+RUG_POINTS = int(os.getenv("RUG_POINTS", 2000))
+SCATTER_POINTS = int(os.getenv("SCATTER_POINTS", 2000))
+FLIGHT_TIMEOUT = float(os.getenv("FLIGHT_TIMEOUT", 300))
+FLIGHT_RESULT_TTL = int(os.getenv("FLIGHT_RESULT_TTL", 30))
+
+#Клиент API: настоящий, с записью ответов или воспроизведение записанных (INVEST_TRANSPORT)
+Client = replay.get_client(Client)
+
+#Адрес API: песочница или продуктовый контур
+invest_targets = {
+    "sandbox": INVEST_GRPC_API_SANDBOX,
+    "production": INVEST_GRPC_API,
+}
+INVEST_TARGET = invest_targets[os.getenv("INVEST_TARGET", "sandbox")]
+
+#Длительность свечи в миллисекундах
+candle_durations = {
+    CandleInterval.CANDLE_INTERVAL_1_MIN: 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_2_MIN: 2 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_3_MIN: 3 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_5_MIN: 5 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_15_MIN: 15 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_30_MIN: 30 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_HOUR: 60 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_2_HOUR: 2 * 60 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_4_HOUR: 4 * 60 * 60 * 1000,
+    CandleInterval.CANDLE_INTERVAL_DAY: 24 * 60 * 60 * 1000,
+}
 
 #Кодировка для json
 class NpEncoder(json.JSONEncoder):
@@ -35,6 +87,138 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
+#Потокобезопасный LRU-кэш
+class LRUCache():
+    def __init__(self, size):
+        self.__size = size
+        self.__lock = threading.Lock()
+        self.__items = OrderedDict()
+
+    def get(self, key, default = None):
+        with self.__lock:
+            if key not in self.__items: return default
+            self.__items.move_to_end(key)
+            return self.__items[key]
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__items[key] = value
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.__size: self.__items.popitem(last = False)
+
+
+#Объединение одинаковых одновременных расчетов (single-flight).
+#Внутри процесса вызовы с одним ключом ждут результата первого вызова, между процессами (фоновые задачи)
+#расчет по ключу выполняется под блокировкой в кэше на диске. Блокировка завершенного процесса снимается.
+class SingleFlight():
+    def __init__(self, cache, timeout):
+        self.__cache = cache
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        self.__flights = {}
+
+    @staticmethod
+    def __is_alive(pid):
+        try: return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess: return False
+
+    #Блокировка ключа между процессами, значение блокировки - pid владельца.
+    #Без expiring блокировка не истекает по времени и снимается только при завершении владельца (для долгих операций).
+    @contextmanager
+    def lock(self, key, expiring = True):
+        lock_key = f"flight:{key}"
+        pid = os.getpid()
+        while not self.__cache.add(lock_key, pid, expire = self.__timeout if expiring else None):
+            owner = self.__cache.get(lock_key)
+            if owner is not None and not self.__is_alive(owner):
+                with self.__cache.transact():
+                    if self.__cache.get(lock_key) == owner: self.__cache.delete(lock_key)
+            time.sleep(0.01)
+
+        try: yield
+        finally:
+            with self.__cache.transact():
+                if self.__cache.get(lock_key) == pid: self.__cache.delete(lock_key)
+
+    #Выполнить function() или дождаться результата такого же выполняющегося вызова в этом процессе
+    def run(self, key, function):
+        with self.__lock:
+            flight = self.__flights.get(key)
+            is_leader = flight is None
+            if is_leader: flight = self.__flights[key] = Future()
+        if not is_leader: return flight.result()
+
+        try:
+            with self.lock(key): result = function()
+            flight.set_result(result)
+            return result
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        finally:
+            with self.__lock: del self.__flights[key]
+
+
+#Пул долгоживущих клиентов API.
+#Каналы gRPC потокобезопасны, поэтому клиенты не выдаются в монопольное пользование, а раздаются по кругу.
+#Клиент, на котором произошла ошибка соединения, пересоздается при следующем обращении.
+class ClientPool():
+    reconnect_codes = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.INTERNAL, grpc.StatusCode.UNKNOWN)
+
+    def __init__(self, token, target, size):
+        self.__token = token
+        self.__target = target
+        self.__lock = threading.Lock()
+        self.__clients = [None] * size
+        self.__counter = itertools.count()
+        self.__pid = os.getpid()
+
+    def __connect(self):
+        client = Client(self.__token, target = self.__target)
+        services = client.__enter__()
+        return client, services
+
+    def __disconnect(self, connection):
+        try: connection[0].__exit__(None, None, None)
+        except Exception: pass
+
+    def __get(self, index):
+        with self.__lock:
+            #После fork каналы родительского процесса не используются
+            if self.__pid != os.getpid():
+                self.__clients = [None] * len(self.__clients)
+                self.__pid = os.getpid()
+            if self.__clients[index] is None: self.__clients[index] = self.__connect()
+            return self.__clients[index]
+
+    def __reset(self, index, connection):
+        with self.__lock:
+            if self.__clients[index] is not connection: return
+            self.__clients[index] = None
+        self.__disconnect(connection)
+
+    @contextmanager
+    def client(self):
+        index = next(self.__counter) % len(self.__clients)
+        connection = self.__get(index)
+        try:
+            yield connection[1]
+        except (RequestError, grpc.RpcError) as error:
+            code = error.code if isinstance(error, RequestError) else error.code()
+            if code in self.reconnect_codes: self.__reset(index, connection)
+            raise
+
+    def close(self):
+        with self.__lock:
+            clients = self.__clients
+            self.__clients = [None] * len(clients)
+        for connection in clients:
+            if connection is not None and self.__pid == os.getpid(): self.__disconnect(connection)
+
+
+client_pool = ClientPool(TOKEN, INVEST_TARGET, CLIENT_POOL_SIZE)
+atexit.register(client_pool.close)
+
 #Получить временные интервалы для акции
 def get_time_intervals(figi):
     time_intervals = [
@@ -61,9 +245,13 @@ def get_time_intervals(figi):
 
 #Получить акцию по figi
 def get_share(figi):
-    with Client(TOKEN, target=INVEST_GRPC_API_SANDBOX) as client:
-        share = client.instruments.share_by(id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, id=figi)
-        return share.instrument
+    share = instrument_catalog.get_share(figi)
+    if share is not None: return share
+
+    with metrics.timer("api", "share_by"), client_pool.client() as client:
+        share = client.instruments.share_by(id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, id=figi).instrument
+    instrument_catalog.add_share(share)
+    return share
     
 #Математическое округление
 def math_round(number, precision):
@@ -79,7 +267,7 @@ def math_round(number, precision):
 
 #Выгрузить список всех акций в Excel
 def shares_to_excel():
-    with Client(TOKEN, target=INVEST_GRPC_API_SANDBOX) as client:
+    with metrics.timer("api", "shares"), client_pool.client() as client:
         shares_df = pd.DataFrame([vars(share) for share in client.instruments.shares().instruments])
 
         for col in shares_df:
@@ -89,31 +277,82 @@ def shares_to_excel():
         shares_df.to_excel("shares_tmp.xlsx")
         print(shares_df.info())
 
-#Получить акции, доступные для торговли
-def get_available_shares():
-    with Client(TOKEN, target=INVEST_GRPC_API_SANDBOX) as client:
-        shares_df = pd.DataFrame([vars(share) for share in client.instruments.shares().instruments])
-        for col in shares_df:
-            if is_datetime64tz_dtype(shares_df[col]):
-                shares_df[col] = shares_df[col].dt.tz_localize(None)
+#Сформировать датафрейм акций, доступных для торговли
+def get_available_shares_df(shares):
+    shares_df = pd.DataFrame([vars(share) for share in shares])
+    for col in shares_df:
+        if is_datetime64tz_dtype(shares_df[col]):
+            shares_df[col] = shares_df[col].dt.tz_localize(None)
 
-        shares_df = shares_df.loc[(shares_df["buy_available_flag"] == shares_df["sell_available_flag"]) & shares_df["buy_available_flag"]]
+    shares_df = shares_df.loc[(shares_df["buy_available_flag"] == shares_df["sell_available_flag"]) & shares_df["buy_available_flag"]]
 
     return shares_df
 
-#Сформировать данные выпадающего списка акций
-def get_share_selectdata():  
-    shares_df = get_available_shares()
+#Каталог акций: загружается при первом обращении и обновляется в фоне по истечении TTL.
+#До окончания фонового обновления отдаются прежние данные.
+class InstrumentCatalog():
+    def __init__(self, ttl):
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__loaded_at = None
+        self.__refreshing = False
+        self.__shares = {}
+        self.__available_shares_df = None
+        self.__selectdata = []
+
+    def __load(self):
+        with metrics.timer("api", "shares"), client_pool.client() as client:
+            shares = client.instruments.shares().instruments
+
+        available_shares_df = get_available_shares_df(shares)
+        selectdata = [{"value": figi, "label": f"{name} ({ticker})"} for figi, name, ticker in zip(available_shares_df["figi"], available_shares_df["name"], available_shares_df["ticker"])]
+
+        self.__shares = {share.figi: share for share in shares}
+        self.__available_shares_df = available_shares_df
+        self.__selectdata = selectdata
+        self.__loaded_at = time.monotonic()
 
-    selectdata = []
-    for index, row in shares_df.iterrows():
-        data = {}
-        data["value"] = row["figi"]
-        data["label"] = f"{row['name']} ({row['ticker']})"
+    def __refresh(self):
+        try: self.__load()
+        finally: self.__refreshing = False
 
-        selectdata.append(data)
+    def __check(self):
+        if self.__loaded_at is None:
+            with self.__lock:
+                if self.__loaded_at is None: self.__load()
+        elif time.monotonic() - self.__loaded_at > self.__ttl and not self.__refreshing:
+            with self.__lock:
+                if self.__refreshing: return
+                self.__refreshing = True
+            threading.Thread(target = self.__refresh, daemon = True).start()
 
-    return selectdata
+    def get_share(self, figi):
+        self.__check()
+        return self.__shares.get(figi)
+
+    def add_share(self, share):
+        self.__shares = {**self.__shares, share.figi: share}
+
+    @property
+    def available_shares_df(self):
+        self.__check()
+        return self.__available_shares_df
+
+    @property
+    def selectdata(self):
+        self.__check()
+        return self.__selectdata
+
+
+instrument_catalog = InstrumentCatalog(CATALOG_TTL)
+
+#Получить акции, доступные для торговли
+def get_available_shares():
+    return instrument_catalog.available_shares_df.copy()
+
+#Сформировать данные выпадающего списка акций
+def get_share_selectdata():  
+    return [dict(data) for data in instrument_catalog.selectdata]
 
 
 
@@ -142,9 +381,9 @@ class DeltaString():
     def color(self): return self.__color
 
 
-#Исключить выбросы по правилу трех сигм
-def remove_outliers(data_df, column):
-    std = np.std(data_df[column], ddof=1)
+#Исключить выбросы по правилу трех сигм (стандартное отклонение можно передать заранее рассчитанным)
+def remove_outliers(data_df, column, std = None):
+    if std is None: std = np.std(data_df[column], ddof=1)
     med = np.median(data_df[column])
     lower_bound = med - 3 * std
     upper_bound = med + 3 * std
@@ -170,6 +409,199 @@ def utc_to_local(utc_dt, timezone):
 def local_to_utc(local_dt):
     return local_dt.astimezone(pytz.utc)
 
+def time_to_label(time_ms):
+    return utc_to_local(datetime.fromtimestamp(time_ms / 1000, pytz.UTC), "Europe/Moscow").strftime("%d %b %Y %H:%M")
+
+def times_to_labels(times_ms):
+    return pd.to_datetime(np.asarray(times_ms, dtype = np.int64), unit = "ms", utc = True).tz_convert("Europe/Moscow").strftime("%d %b %Y %H:%M")
+
+
+#Прореживание --------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#Выбрать точки ряда методом Largest-Triangle-Three-Buckets. Возвращает индексы выбранных точек (первая и последняя сохраняются).
+def lttb_indexes(values, threshold):
+    values = np.asarray(values, dtype = np.float64)
+    if threshold >= len(values) or threshold < 3: return np.arange(len(values))
+
+    #Границы корзин и средние точки корзин не зависят от выбора и считаются заранее
+    edges = (np.arange(threshold - 1) * ((len(values) - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = len(values) - 1
+    avg_x = np.append((edges[1:-1] + edges[2:] - 1) / 2, len(values) - 1)
+    avg_y = np.append(np.add.reduceat(values[:-1], edges[1:-1]) / np.diff(edges[1:]), values[-1])
+
+    indexes = np.empty(threshold, dtype = np.int64)
+    indexes[0] = selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        areas = np.abs((selected - avg_x[bucket]) * (values[start:end] - values[selected]) - (selected - np.arange(start, end)) * (avg_y[bucket] - values[selected]))
+        selected = start + int(areas.argmax())
+        indexes[bucket + 1] = selected
+    indexes[-1] = len(values) - 1
+
+    return indexes
+
+#Выбрать индексы свечей для отображения на графике не более чем в points точках.
+#Если задан диапазон [start, end], на него отводится большая часть точек, а его границы всегда попадают в выборку.
+def get_chart_indexes(candles_df, points = CHART_POINTS, start = None, end = None):
+    if len(candles_df) <= points: return np.arange(len(candles_df))
+    if start is None or end is None: start, end = 0, len(candles_df) - 1
+
+    parts = [(0, start), (start, end + 1), (end + 1, len(candles_df))]
+    outer_size = len(candles_df) - (end + 1 - start)
+    outer_points = points // 4 if outer_size else 0
+
+    indexes = [np.array([start, end])]
+    for part_start, part_stop in parts:
+        if part_start >= part_stop: continue
+        if (part_start, part_stop) == (start, end + 1): part_points = points - outer_points
+        else: part_points = outer_points * (part_stop - part_start) // outer_size
+
+        #Для короткой внешней части, на которую не хватает точек на оба ряда, сохраняются только ее границы
+        if part_points < 6:
+            indexes.append(np.array([part_start, part_stop - 1]))
+            continue
+
+        #Ряды цены и баланса прореживаются независимо, выборки объединяются
+        for column in ["open", "balance"]:
+            values = candles_df[column].values[part_start:part_stop]
+            indexes.append(part_start + lttb_indexes(values, part_points // 2))
+
+    return np.unique(np.concatenate(indexes))
+
+#Получить точки графика курса для свечей с позициями indexes (подписи времени формируются только для них)
+@metrics.timed("stage")
+def get_chart_records(candles_df, indexes):
+    chart_df = candles_df[["open", "balance"]].iloc[indexes]
+    chart_df.insert(0, "datetime", times_to_labels(chart_df.index))
+    return chart_df.to_dict("records")
+
+#Получить данные для графика курса
+def get_chart_data(candles_df, start = None, end = None):
+    return get_chart_records(candles_df, get_chart_indexes(candles_df, CHART_POINTS, start, end))
+
+
+#Распределение -------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#Распределения срезов наборов данных: ключ - (набор данных, версия, границы среза, фильтр)
+distribution_cache = LRUCache(DISTRIBUTION_CACHE_SIZE)
+
+#Оценка плотности (KDE) с гауссовым ядром на равномерной сетке.
+#Значения линейно раскладываются по узлам сетки, затем веса узлов сворачиваются с ядром через FFT: O(n + grid·log(grid)).
+#Ширина ядра - по правилу Скотта, как в scipy.stats.gaussian_kde.
+def binned_kde(values, grid):
+    step = grid[1] - grid[0]
+    bandwidth = np.std(values, ddof = 1) * len(values) ** (-1 / 5)
+    if not bandwidth > 0: bandwidth = step
+
+    position = np.clip((values - grid[0]) / step, 0, len(grid) - 1)
+    lower = np.minimum(position.astype(np.int64), len(grid) - 2)
+    fraction = position - lower
+    weights = np.bincount(lower, 1 - fraction, len(grid)) + np.bincount(lower + 1, fraction, len(grid))
+
+    radius = min(len(grid) - 1, int(np.ceil(4 * bandwidth / step)))
+    offsets = np.arange(-radius, radius + 1) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+
+    size = 1 << int(np.ceil(np.log2(len(grid) + len(kernel) - 1)))
+    density = np.fft.irfft(np.fft.rfft(weights, size) * np.fft.rfft(kernel, size), size)[radius:radius + len(grid)]
+    return np.maximum(density, 0) / len(values)
+
+#Рассчитать распределение значений: гистограмма (плотность вероятности), KDE и точки rug-графика.
+#Если значений больше rug_points, точки rug-графика объединяются по мелким корзинам с количеством значений в подписи.
+@metrics.timed("stage")
+def get_distribution(values, times_ms, bins = 50, grid_size = 512, rug_points = RUG_POINTS):
+    values = np.asarray(values, dtype = np.float64)
+    if not len(values): return None
+
+    low, high = values.min(), values.max()
+    if low == high: low, high = low - 0.5, high + 0.5
+
+    counts, edges = np.histogram(values, bins, (low, high))
+    grid = np.linspace(low, high, grid_size)
+    distribution = {
+        "hist_x": (edges[:-1] + edges[1:]) / 2,
+        "hist_y": counts / (len(values) * (edges[1] - edges[0])),
+        "bin_size": edges[1] - edges[0],
+        "kde_x": grid,
+        "kde_y": binned_kde(values, grid) if len(values) > 1 else np.zeros(grid_size),
+    }
+
+    if len(values) <= rug_points:
+        distribution["rug_x"] = values
+        distribution["rug_text"] = list(times_to_labels(times_ms))
+    else:
+        rug_counts, rug_edges = np.histogram(values, rug_points, (low, high))
+        filled = rug_counts > 0
+        distribution["rug_x"] = ((rug_edges[:-1] + rug_edges[1:]) / 2)[filled]
+        distribution["rug_text"] = [f"{count} свечей" for count in rug_counts[filled]]
+
+    return distribution
+
+
+#Корреляция ----------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#Размеры векторов и горизонты (в свечах) будущей доходности для таблицы корреляций
+correlation_vector_sizes = [1, 2, 3, 5, 7, 10]
+correlation_lags = [1, 2, 3, 5, 10]
+
+#Корреляции срезов наборов данных: ключ - (набор данных, версия, границы среза, размер вектора)
+correlation_cache = LRUCache(DISTRIBUTION_CACHE_SIZE)
+
+#Ранги значений (одинаковым значениям - средний ранг)
+def rank_values(values):
+    _, inverse, counts = np.unique(values, return_inverse = True, return_counts = True)
+    ranks = np.cumsum(counts) - (counts - 1) / 2
+    return ranks[inverse]
+
+#Корреляция Пирсона строк матрицы x с рядом y
+def pearson_rows(x, y):
+    x = x - x.mean(axis = 1, keepdims = True)
+    y = y - y.mean()
+    denominator = np.sqrt((x * x).sum(axis = 1) * (y * y).sum())
+    with np.errstate(invalid = "ignore", divide = "ignore"): return np.where(denominator > 0, x @ y / denominator, np.nan)
+
+#Рассчитать корреляции вектора свечи с будущей доходностью (в процентах) через lag свечей:
+#closes[t + lag] / closes[t] - 1. Все пары берутся на одних и тех же свечах (без последних max(lags)), поэтому сравнимы.
+#Вектора считаются по свечам до start (окно вектора у первых свечей среза полное), в корреляцию входят свечи [start, end].
+#Возвращает таблицу (размер вектора, горизонт, пары, Пирсон, Спирмен) и данные графика для vector_size и горизонта 1:
+#точки при количестве пар не больше scatter_points, иначе - двумерная гистограмма плотности bins x bins.
+@metrics.timed("stage")
+def get_correlation(candles_df, start, end, vector_size, vector_sizes = correlation_vector_sizes, lags = correlation_lags, scatter_points = SCATTER_POINTS, bins = 80):
+    vector_sizes = sorted(set(vector_sizes) | {vector_size})
+    warmup = max(start - max(vector_sizes), 0)
+    opens = candles_df["open"].values[warmup:end + 1]
+    closes = candles_df["close"].values[warmup:end + 1]
+    offset = start - warmup
+
+    size = end + 1 - start - max(lags)
+    if size < 3: return None
+
+    vectors = calc_vectors(opens, closes, vector_sizes)
+    x = np.vstack([vectors[vector_size][offset:offset + size] for vector_size in vector_sizes])
+    x_ranks = np.vstack([rank_values(row) for row in x])
+    base = closes[offset:offset + size]
+
+    rows = []
+    for lag in lags:
+        y = (closes[offset + lag:offset + lag + size] / base - 1) * 100
+        pearson = pearson_rows(x, y)
+        spearman = pearson_rows(x_ranks, rank_values(y))
+        rows += [{"vector_size": row_size, "lag": lag, "pairs": size, "pearson": pearson[index], "spearman": spearman[index]} for index, row_size in enumerate(vector_sizes)]
+
+    #Данные графика: вектор выбранного размера и доходность следующей свечи
+    x = x[vector_sizes.index(vector_size)]
+    y = (closes[offset + 1:offset + 1 + size] / base - 1) * 100
+    if size <= scatter_points: chart = {"x": x, "y": y}
+    else:
+        #Границы гистограммы по 0.5-99.5 процентилям, чтобы единичные выбросы не сжимали картину
+        x_range, y_range = np.percentile(x, [0.5, 99.5]), np.percentile(y, [0.5, 99.5])
+        if x_range[0] == x_range[1]: x_range = x_range + [-0.5, 0.5]
+        if y_range[0] == y_range[1]: y_range = y_range + [-0.5, 0.5]
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins, [x_range, y_range])
+        chart = {"x": (x_edges[:-1] + x_edges[1:]) / 2, "y": (y_edges[:-1] + y_edges[1:]) / 2, "counts": counts.T}
+
+    return {"table": pd.DataFrame(rows), "chart": chart}
+
 
 #Логика
 
@@ -182,67 +614,582 @@ def get_sell_coef_limit(comission, growth_coef):
 
 
 
+#Колонки свечей: цены хранятся как целая часть и нано-доли (Quotation), время - в миллисекундах UTC
+candle_columns = ["time", "open_units", "open_nano", "high_units", "high_nano", "low_units", "low_nano", "close_units", "close_nano", "volume"]
+
+#Собрать свечи из API в предвыделенные массивы int64. Возвращает словарь колонок и время первой незавершенной свечи.
+def collect_candles(candles, size_hint = 1024):
+    rows = np.empty((max(size_hint, 16), len(candle_columns)), dtype = np.int64)
+    incomplete_time = None
+
+    count = 0
+    for candle in candles:
+        if count == len(rows): rows = np.concatenate((rows, np.empty_like(rows)))
+
+        time_ms = int(candle.time.timestamp() * 1000)
+        if incomplete_time is None and not candle.is_complete: incomplete_time = time_ms
+        rows[count] = (
+            time_ms,
+            candle.open.units, candle.open.nano,
+            candle.high.units, candle.high.nano,
+            candle.low.units, candle.low.nano,
+            candle.close.units, candle.close.nano,
+            candle.volume,
+        )
+        count += 1
+
+    return dict(zip(candle_columns, rows[:count].T)), incomplete_time
+
+#Перевести колонки свечей в цены одной векторной операцией
+def columns_to_prices(columns):
+    prices = {"time": columns["time"], "volume": columns["volume"]}
+    for price in ["open", "high", "low", "close"]:
+        prices[price] = columns[price + "_units"] + np.round(columns[price + "_nano"] / 1e9, 9)
+    return prices
+
+#Сохранить загруженные из API свечи промежутка [gap_start, gap_end) в локальное хранилище.
+#Последняя (формирующаяся) свеча может измениться, поэтому ее промежуток не считается загруженным.
+def store_candles(figi, candle_interval, candles, gap_start, gap_end):
+    now_ms = int(datetime.now(pytz.UTC).timestamp() * 1000)
+    covered_end = min(gap_end, now_ms - candle_durations[candle_interval])
+
+    size_hint = min((gap_end - gap_start) // candle_durations[candle_interval] + 1, 1 << 16)
+    columns, incomplete_time = collect_candles(candles, size_hint)
+    if incomplete_time is not None: covered_end = min(covered_end, incomplete_time)
+
+    candle_store.put(figi, candle_interval, columns_to_prices(columns), gap_start, max(gap_start, covered_end))
+    return len(columns["time"])
+
+#Интервалы, свечи которых собираются из более мелких: границы свечей кратны их длительности от начала эпохи UTC
+derivable_intervals = [
+    CandleInterval.CANDLE_INTERVAL_1_MIN,
+    CandleInterval.CANDLE_INTERVAL_2_MIN,
+    CandleInterval.CANDLE_INTERVAL_3_MIN,
+    CandleInterval.CANDLE_INTERVAL_5_MIN,
+    CandleInterval.CANDLE_INTERVAL_15_MIN,
+    CandleInterval.CANDLE_INTERVAL_30_MIN,
+    CandleInterval.CANDLE_INTERVAL_HOUR,
+    CandleInterval.CANDLE_INTERVAL_2_HOUR,
+    CandleInterval.CANDLE_INTERVAL_4_HOUR,
+]
+
+#Собрать свечи длительности duration из более мелких свечей (open первой, close последней, max high, min low, сумма объемов).
+#Корзины без сделок (вне торговых сессий) свечей не дают.
+def resample_candles(candles_df, duration):
+    times = candles_df["time"].values
+    if not len(times): return {column: np.array([]) for column in ["time", "open", "high", "low", "close", "volume"]}
+
+    buckets = times // duration * duration
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    ends = np.concatenate((starts[1:], [len(times)])) - 1
+
+    return {
+        "time": buckets[starts],
+        "open": candles_df["open"].values[starts],
+        "high": np.maximum.reduceat(candles_df["high"].values, starts),
+        "low": np.minimum.reduceat(candles_df["low"].values, starts),
+        "close": candles_df["close"].values[ends],
+        "volume": np.add.reduceat(candles_df["volume"].values, starts),
+    }
+
+#Собрать свечи промежутка [gap_start, gap_end) из загруженных свечей source_interval.
+#Собираются только свечи, период которых полностью загружен; возвращаются промежутки, которые собрать не удалось.
+def derive_candle_gap(figi, candle_interval, source_interval, gap_start, gap_end):
+    duration = candle_durations[candle_interval]
+    buckets = np.arange(-(-gap_start // duration) * duration, gap_end, duration)
+    if not len(buckets):
+        candle_store.put(figi, candle_interval, resample_candles(pd.DataFrame(columns = ["time", "open", "high", "low", "close", "volume"]), duration), gap_start, gap_end)
+        return []
+
+    is_derivable = np.ones(len(buckets), dtype = bool)
+    for source_start, source_end in candle_store.get_gaps(figi, source_interval, buckets[0], buckets[-1] + duration):
+        is_derivable &= (buckets + duration <= source_start) | (buckets >= source_end)
+    if not is_derivable.any(): return [(gap_start, gap_end)]
+
+    derived = resample_candles(candle_store.load(figi, source_interval, buckets[0], buckets[-1] + duration), duration)
+
+    #Промежуток делится на участки подряд идущих собираемых и несобираемых свечей
+    slot_starts = np.concatenate(([gap_start], buckets[1:]))
+    slot_ends = np.concatenate((buckets[1:], [gap_end]))
+    run_starts = np.flatnonzero(np.concatenate(([True], is_derivable[1:] != is_derivable[:-1])))
+    run_ends = np.concatenate((run_starts[1:], [len(buckets)])) - 1
+
+    gaps = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        start, end = int(slot_starts[run_start]), int(slot_ends[run_end])
+        if not is_derivable[run_start]:
+            gaps.append((start, end))
+            continue
+
+        in_run = (derived["time"] >= start) & (derived["time"] < end)
+        candle_store.put(figi, candle_interval, {column: values[in_run] for column, values in derived.items()}, start, end)
+
+    return gaps
+
+#Собрать недостающие свечи интервала из более мелких загруженных свечей (от крупных источников к мелким).
+#Возвращает промежутки, которые нужно загрузить из API.
+def derive_candle_gaps(figi, candle_interval, gaps):
+    if candle_interval not in derivable_intervals: return gaps
+
+    duration = candle_durations[candle_interval]
+    for source_interval in reversed(derivable_intervals):
+        if not gaps: break
+        if candle_durations[source_interval] >= duration or duration % candle_durations[source_interval]: continue
+        gaps = [gap for gap_start, gap_end in gaps for gap in derive_candle_gap(figi, candle_interval, source_interval, gap_start, gap_end)]
+
+    return gaps
+
+#Загрузить из API недостающие свечи в локальное хранилище.
+#Одновременные загрузки одного промежутка объединяются, ожидавшие вызовы находят свечи уже в хранилище.
+def fill_candle_gaps(figi, candle_interval, start_ms, end_ms):
+    if not candle_store.get_gaps(figi, candle_interval, start_ms, end_ms): return
+    single_flight.run(f"candles:{figi}:{int(candle_interval)}:{start_ms}:{end_ms}", lambda: load_candle_gaps(figi, candle_interval, start_ms, end_ms))
+
+def load_candle_gaps(figi, candle_interval, start_ms, end_ms):
+    gaps = candle_store.get_gaps(figi, candle_interval, start_ms, end_ms)
+    gaps = derive_candle_gaps(figi, candle_interval, gaps)
+    if not gaps: return
+
+    with client_pool.client() as client:
+        for gap_start, gap_end in gaps:
+            from_ = datetime.fromtimestamp(gap_start / 1000, pytz.UTC)
+            to = datetime.fromtimestamp(gap_end / 1000, pytz.UTC)
+            with metrics.timer("api", "get_all_candles"):
+                candles = client.get_all_candles(figi=figi, from_=from_, to=to, interval=candle_interval)
+                count = store_candles(figi, candle_interval, candles, gap_start, gap_end)
+            metrics.observe("api_candles", "get_all_candles", count)
+
 #Получить датафрейм свечей для построения графиков
+@metrics.timed("stage")
 def get_candles_df(figi, candle_interval, time_interval, end_datetime = None):
     if end_datetime == None: end_datetime = datetime.utcnow().replace(tzinfo=pytz.UTC)
     start_datetime = end_datetime - time_interval
 
-    candles_df = []
-    with Client(TOKEN) as client: 
-        candles = client.get_all_candles(figi=figi, from_=start_datetime, to=end_datetime, interval=candle_interval)
-        for candle in candles:
-            candle_data = {}
-            candle_data["datetime"] = utc_to_local(candle.time, "Russia/Moscow").strftime("%d %b %Y %H:%M")
-            candle_data["open"] = quotation_to_float(candle.open)
-            candle_data["close"] = quotation_to_float(candle.close)
-            candles_df.append(candle_data)
+    return get_candles_range_df(figi, candle_interval, int(start_datetime.timestamp() * 1000), int(end_datetime.timestamp() * 1000))
 
-    return pd.DataFrame(candles_df)
+#Получить датафрейм свечей промежутка [start_ms, end_ms)
+def get_candles_range_df(figi, candle_interval, start_ms, end_ms):
+    fill_candle_gaps(figi, candle_interval, start_ms, end_ms)
 
-#Получить историю баланса на основе данных
-def get_balance_history(candles_df, purchase_coef_limit, part_of_sell_limit, comission):
-    status = {"broker": True, "purchase_price": None, "growth_coef": None, "sell_coef_limit": None}
+    stored_df = candle_store.load(figi, candle_interval, start_ms, end_ms)
+
+    candles_df = pd.DataFrame(
+        {
+            "open": stored_df["open"].values,
+            "close": stored_df["close"].values,
+            "high": stored_df["high"].values,
+            "low": stored_df["low"].values,
+            "volume": stored_df["volume"].values,
+        },
+        index = pd.Index(stored_df["time"].values.astype(np.int64), name = "time")
+    )
+
+    return candles_df
+
+#Начальное состояние стратегии
+def get_initial_status():
+    return {"broker": True, "purchase_price": None, "growth_coef": None, "sell_coef_limit": None, "balance": 1, "trades": 0}
 
-    balance_history = []
-    for index, candle in candles_df.iterrows():
+#Найти выход из позиции, начиная с index. Возвращает индекс свечи продажи (или None) и обновленное состояние позиции.
+#Максимум цены и лимит продажи считаются накопительно по блокам, размер блока удваивается, пока выход не найден.
+def find_position_exit(closes, index, purchase_price, growth_coef, sell_coef_limit, part_of_sell_limit, comission):
+    block_size = 64
+    while index < len(closes):
+        block = closes[index:index + block_size]
+
+        growth_coefs = get_growth_coef(purchase_price, block)
+        prev_growth_coefs = np.maximum.accumulate(np.concatenate(([growth_coef], growth_coefs[:-1])))
+        max_prices = purchase_price * (1 + prev_growth_coefs)
+
+        is_growth = block > max_prices
+        was_growth = np.concatenate(([False], np.logical_or.accumulate(is_growth[:-1])))
+        sell_coef_limits = np.where(was_growth, get_sell_coef_limit(comission, prev_growth_coefs) * part_of_sell_limit, sell_coef_limit)
+        sell_coefs = 1 - block / max_prices
+
+        exits = np.flatnonzero(~is_growth & (sell_coefs > sell_coef_limits))
+        if len(exits):
+            exit = exits[0]
+            return index + exit, prev_growth_coefs[exit], sell_coef_limits[exit]
+
+        if is_growth.any():
+            growth_coef = max(growth_coef, growth_coefs.max())
+            sell_coef_limit = get_sell_coef_limit(comission, growth_coef) * part_of_sell_limit
+        index += len(block)
+        block_size *= 2
+
+    return None, growth_coef, sell_coef_limit
+
+#Прогнать стратегию по массивам open/close/vector.
+#status - состояние на начало массивов (позиция, цена покупки, рост, лимит продажи, баланс), возвращается состояние на конец.
+#Периоды ожидания пропускаются поиском по индексам покупок, короткие позиции считаются поэлементно, длинные - блоками в find_position_exit.
+@metrics.timed("stage")
+def run_strategy(opens, closes, vectors, purchase_coef_limit, part_of_sell_limit, comission, status = None, scalar_steps = 16):
+    opens = np.ascontiguousarray(opens, dtype = np.float64)
+    closes = np.ascontiguousarray(closes, dtype = np.float64)
+    vectors = np.ascontiguousarray(vectors, dtype = np.float64)
+    status = dict(status) if status else get_initial_status()
+
+    returns = (closes / opens - 1).tolist()
+    close_list = closes.tolist()
+    balance_history = np.empty(len(closes))
+    purchase_indexes = np.flatnonzero(vectors > purchase_coef_limit)
+    balance = status["balance"]
+
+    index = 0
+    while index < len(closes):
         if status["broker"]:
-            balance = balance_history[index - 1] if index > 0 else 1
+            #Ожидание покупки: баланс не меняется до ближайшей свечи с вектором выше порога
+            position = purchase_indexes.searchsorted(index)
+            if position == len(purchase_indexes):
+                balance_history[index:] = balance
+                break
+
+            purchase_index = int(purchase_indexes[position])
+            balance_history[index:purchase_index] = balance
+            balance -= balance * comission
+            balance_history[purchase_index] = balance
+
+            status["purchase_price"] = close_list[purchase_index]
+            status["growth_coef"] = 0
+            status["sell_coef_limit"] = get_sell_coef_limit(comission, status["growth_coef"])
+            status["broker"] = False
+            status["trades"] += 1
+            index = purchase_index + 1
+            continue
+
+        #Удержание позиции: первые свечи поэлементно
+        scalar_stop = min(index + scalar_steps, len(closes))
+        while index < scalar_stop and not status["broker"]:
+            balance += returns[index]
 
-            if candle["vector"] > purchase_coef_limit:
-                status["purchase_price"] = candle["close"]
-                status["growth_coef"] = 0
-                status["sell_coef_limit"] = get_sell_coef_limit(comission, status["growth_coef"])
-                status["broker"] = False
-                balance -= balance * comission
-                #print(f"Покупка: {candles_df.iloc[index + 1]['datetime']}")
-        else:
-            balance += candle["close"] / candle["open"] - 1
-            
             max_price = status["purchase_price"] * (1 + status["growth_coef"])
-            if candle["close"] > max_price:
-                status["growth_coef"] = get_growth_coef(status["purchase_price"], candle["close"])
+            if close_list[index] > max_price:
+                status["growth_coef"] = get_growth_coef(status["purchase_price"], close_list[index])
                 status["sell_coef_limit"] = get_sell_coef_limit(comission, status["growth_coef"]) * part_of_sell_limit
-            else:
-                sell_coef = 1 - candle["close"] / max_price
-                if sell_coef > status["sell_coef_limit"]:
-                    status["broker"] = True
-                    balance -= balance * comission
-                    #print(f"Продажа: {candles_df.iloc[index + 1]['datetime']}")
+            elif 1 - close_list[index] / max_price > status["sell_coef_limit"]:
+                status["broker"] = True
+                balance -= balance * comission
+
+            balance_history[index] = balance
+            index += 1
+        if status["broker"] or index >= len(closes): continue
+
+        #Длинная позиция: поиск продажи блоками, баланс накапливается доходностью свечей
+        sell_index, status["growth_coef"], status["sell_coef_limit"] = find_position_exit(
+            closes, index, status["purchase_price"], status["growth_coef"], status["sell_coef_limit"], part_of_sell_limit, comission
+        )
+        stop = len(closes) if sell_index is None else sell_index + 1
+
+        balances = np.cumsum(np.concatenate(([balance], closes[index:stop] / opens[index:stop] - 1)))
+        balance_history[index:stop] = balances[1:]
+        balance = float(balances[-1])
+
+        if sell_index is not None:
+            balance -= balance * comission
+            balance_history[sell_index] = balance
+            status["broker"] = True
+        index = stop
 
-        balance_history.append(balance)
+    status["balance"] = balance
+    return balance_history, status
 
+#Получить порог покупки: процентиль положительных векторов
+def get_purchase_coef_limit(vectors, percentile = 90):
+    vectors = np.asarray(vectors)
+    return np.percentile(vectors[vectors > 0], percentile)
+
+#Получить итоги стратегии: конечный баланс, количество сделок и максимальная просадка
+def get_strategy_summary(balance_history, status):
+    if not len(balance_history): return {"balance": status["balance"], "trades": status["trades"], "drawdown": 0.0}
+
+    peaks = np.maximum.accumulate(balance_history)
+    drawdown = float(((peaks - balance_history) / peaks).max())
+
+    return {"balance": float(balance_history[-1]), "trades": status["trades"], "drawdown": drawdown}
+
+#Получить историю баланса на основе данных
+@metrics.timed("stage")
+def get_balance_history(candles_df, purchase_coef_limit, part_of_sell_limit, comission):
+    balance_history, status = run_strategy(candles_df["open"], candles_df["close"], candles_df["vector"], purchase_coef_limit, part_of_sell_limit, comission)
     return balance_history
 
-#Получить вектора свечей
-def get_vectors(candles_df, vector_size):
-    vectors = []
-    vector_data = []
-    for index, candle in candles_df.iterrows():
-        vector_data.append(candle["close"] / candle["open"] - 1)
-        if index > vector_size: vector_data.remove(vector_data[0])
-        vector = sum(vector_data) / len(vector_data)
-        vectors.append(vector * 100)
+#Рассчитать вектора (скользящее среднее доходности свечей в процентах) для одного или нескольких размеров.
+#Окно вектора размера n содержит n + 1 последних свечей, в начале ряда - все свечи от первой.
+def calc_vectors(opens, closes, vector_sizes):
+    returns = np.asarray(closes, dtype = np.float64) / np.asarray(opens, dtype = np.float64) - 1
+    sums = np.concatenate(([0], np.cumsum(returns)))
+    ends = np.arange(1, len(returns) + 1)
+
+    vectors = {}
+    for vector_size in vector_sizes:
+        starts = np.maximum(ends - vector_size - 1, 0)
+        vectors[vector_size] = (sums[ends] - sums[starts]) / (ends - starts) * 100
 
     return vectors
 
+#Рассчитать вектора свечей, продолжающих ряд: returns - доходности предшествующих свечей (последние vector_size)
+def calc_next_vectors(returns, opens, closes, vector_size):
+    new_returns = np.asarray(closes, dtype = np.float64) / np.asarray(opens, dtype = np.float64) - 1
+    sums = np.concatenate(([0], np.cumsum(np.concatenate((returns, new_returns)))))
+    ends = np.arange(len(returns) + 1, len(sums))
+    starts = np.maximum(ends - vector_size - 1, 0)
+    return (sums[ends] - sums[starts]) / (ends - starts) * 100
+
+#Получить вектора свечей. Для списка размеров возвращается словарь {размер: вектора}.
+@metrics.timed("stage")
+def get_vectors(candles_df, vector_size):
+    if np.ndim(vector_size): return calc_vectors(candles_df["open"], candles_df["close"], vector_size)
+    return calc_vectors(candles_df["open"], candles_df["close"], [vector_size])[vector_size]
+
+
+#Статистики по диапазонам свечей для запросов ползунка.
+#Количество, сумма и сумма квадратов векторов по знаку - префиксные суммы, минимум и максимум open/balance -
+#разреженная таблица по минимумам/максимумам блоков (внутри неполных блоков на краях диапазона - прямой просмотр).
+#Границы диапазонов включительные.
+class RangeStats():
+    def __init__(self, candles_df, block_size = 32):
+        self.__block_size = block_size
+        self.__columns = {column: candles_df[column].values for column in ["open", "balance"]}
+
+        vectors = candles_df["vector"].values
+        self.__vector_sums = {}
+        for sign, mask in {"all": np.ones(len(vectors), dtype = bool), "positive": vectors > 0, "negative": vectors < 0}.items():
+            masked = np.where(mask, vectors, 0)
+            self.__vector_sums[sign] = [np.concatenate(([0], np.cumsum(values))) for values in [mask, masked, masked * masked]]
+
+        self.__tables = {}
+        for column, values in self.__columns.items():
+            blocks = len(values) // block_size
+            block_values = values[:blocks * block_size].reshape(blocks, block_size)
+            self.__tables[column] = {"min": self.__sparse_table(block_values.min(axis = 1), np.minimum), "max": self.__sparse_table(block_values.max(axis = 1), np.maximum)}
+
+    #Уровень k таблицы - результат function по окнам из 2^k блоков
+    @staticmethod
+    def __sparse_table(values, function):
+        table = [values]
+        while 2 ** len(table) <= len(values):
+            previous, width = table[-1], 2 ** (len(table) - 1)
+            table.append(function(previous[:-width], previous[width:]))
+        return table
+
+    def __query(self, column, kind, start, end):
+        start, end = int(start), int(end)
+        values = self.__columns[column]
+        function = np.min if kind == "min" else np.max
+        first_block = -(-start // self.__block_size)
+        last_block = (end + 1) // self.__block_size
+        if last_block <= first_block: return function(values[start:end + 1])
+
+        table = self.__tables[column][kind]
+        level = (last_block - first_block).bit_length() - 1
+        parts = [table[level][first_block], table[level][last_block - 2 ** level]]
+        if start < first_block * self.__block_size: parts.append(function(values[start:first_block * self.__block_size]))
+        if end + 1 > last_block * self.__block_size: parts.append(function(values[last_block * self.__block_size:end + 1]))
+        return function(parts)
+
+    def get_min(self, column, start, end):
+        return self.__query(column, "min", start, end)
+
+    def get_max(self, column, start, end):
+        return self.__query(column, "max", start, end)
+
+    #Значения столбца на границах диапазона
+    def get_bounds(self, column, start, end):
+        return self.__columns[column][start], self.__columns[column][end]
+
+    #Количество, среднее и стандартное отклонение векторов диапазона со знаком sign (all, positive, negative)
+    def get_vector_stats(self, start, end, sign = "all"):
+        count, total, squares = [values[end + 1] - values[start] for values in self.__vector_sums[sign]]
+        count = int(count)
+        mean = total / count if count else None
+        std = np.sqrt(max(squares - count * mean * mean, 0) / (count - 1)) if count > 1 else None
+        return {"count": count, "mean": mean, "std": std}
+
+
+#Наборы данных графиков (свечи, вектора, баланс) хранятся на сервере, в браузер передается только их идентификатор.
+#Наборы, рассчитанные в фоновых задачах (других процессах), передаются через кэш на диске.
+dataset_cache = LRUCache(DATASET_CACHE_SIZE)
+#Наборы данных, дополняемые свечами из потока. Пока подписка держится, они не вытесняются: копия на диске не обновляется.
+pinned_datasets = {}
+dataset_disk_cache = diskcache.Cache(DATASET_DISK_DIR, size_limit = DATASET_DISK_LIMIT)
+single_flight = SingleFlight(dataset_disk_cache, FLIGHT_TIMEOUT)
+
+#Набор данных графика: свечи с векторами и балансом, параметры стратегии и ее состояние перед последней свечой.
+#Последняя свеча может обновляться (формирующаяся свеча из потока), поэтому для ее пересчета хранится
+#состояние стратегии и доходности окна вектора на момент до нее. Датафрейм не изменяется, а заменяется целиком.
+class Dataset():
+    def __init__(self, figi, candle_interval, end_ms, vector_size, candles_df, part_of_sell_limit = 0, comission = 0.0003):
+        self.figi = figi
+        self.candle_interval = candle_interval
+        self.end_ms = end_ms
+        self.vector_size = vector_size
+        self.part_of_sell_limit = part_of_sell_limit
+        self.comission = comission
+        self.version = 0
+        self.__lock = threading.Lock()
+        self.__stats = None
+
+        opens = candles_df["open"].values
+        closes = candles_df["close"].values
+        vectors = get_vectors(candles_df, vector_size)
+        self.purchase_coef_limit = get_purchase_coef_limit(vectors)
+
+        head = max(len(candles_df) - 1, 0)
+        head_balance, self.__status = run_strategy(opens[:head], closes[:head], vectors[:head], self.purchase_coef_limit, part_of_sell_limit, comission)
+        last_balance, _ = run_strategy(opens[head:], closes[head:], vectors[head:], self.purchase_coef_limit, part_of_sell_limit, comission, self.__status)
+        self.__returns = list(closes[max(head - vector_size, 0):head] / opens[max(head - vector_size, 0):head] - 1)
+
+        candles_df["vector"] = vectors
+        candles_df["balance"] = np.concatenate((head_balance, last_balance))
+        self.df = candles_df
+
+    #Блокировка и статистики диапазонов не сериализуются
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_Dataset__lock"]
+        state["_Dataset__stats"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    #Набор данных доходит до текущего момента (можно дополнять свечами из потока)
+    def is_actual(self):
+        now_ms = int(datetime.now(pytz.UTC).timestamp() * 1000)
+        return self.end_ms >= now_ms - candle_durations[self.candle_interval]
+
+    #Статистики по диапазонам для текущей версии набора данных (строятся при первом обращении)
+    @property
+    def stats(self):
+        with self.__lock:
+            if self.__stats is None or self.__stats[0] != self.version: self.__stats = (self.version, RangeStats(self.df))
+            return self.__stats[1]
+
+    #Добавить новую свечу или обновить последнюю. Пересчитываются вектор и баланс только этой свечи.
+    def apply_candle(self, candle):
+        with self.__lock:
+            candles_df = self.df
+            if len(candles_df) and candle["time"] < candles_df.index[-1]: return
+
+            if len(candles_df) and candle["time"] == candles_df.index[-1]: candles_df = candles_df.iloc[:-1]
+            elif len(candles_df):
+                #Предыдущая последняя свеча становится окончательной
+                last = candles_df.iloc[-1]
+                _, self.__status = run_strategy([last["open"]], [last["close"]], [last["vector"]], self.purchase_coef_limit, self.part_of_sell_limit, self.comission, self.__status)
+                self.__returns = (self.__returns + [last["close"] / last["open"] - 1])[-self.vector_size:]
+
+            vector = (sum(self.__returns) + candle["close"] / candle["open"] - 1) / (len(self.__returns) + 1) * 100
+            balance_history, _ = run_strategy([candle["open"]], [candle["close"]], [vector], self.purchase_coef_limit, self.part_of_sell_limit, self.comission, self.__status)
+
+            row = {column: candle.get(column) for column in candles_df.columns}
+            row["vector"] = vector
+            row["balance"] = balance_history[0]
+
+            self.df = pd.concat([candles_df, pd.DataFrame([row], columns = candles_df.columns, index = pd.Index([candle["time"]], name = "time"))])
+            self.end_ms = max(self.end_ms, candle["time"] + candle_durations[self.candle_interval])
+            self.version += 1
+
+    #Получить набор данных, дополненный свечами candles_df и обрезанный до окна [start_ms, end_ms).
+    #candles_df начинается с последней свечи набора (она заменяется, так как могла измениться).
+    #Вектора и баланс считаются только для новых свечей от сохраненного состояния стратегии с прежним порогом покупки,
+    #свечи до start_ms отбрасываются срезом. Исходный набор не изменяется.
+    def extend(self, candles_df, start_ms, end_ms):
+        with self.__lock:
+            held_df, status, returns = self.df, self.__status, self.__returns
+
+        if len(held_df):
+            candles_df = candles_df[candles_df.index >= held_df.index[-1]]
+            if not len(candles_df) or candles_df.index[0] != held_df.index[-1]:
+                candles_df = pd.concat([held_df.iloc[-1:][candles_df.columns], candles_df])
+            held_df = held_df.iloc[:-1]
+
+        opens = candles_df["open"].values
+        closes = candles_df["close"].values
+        new_returns = closes / opens - 1
+        vectors = calc_next_vectors(returns, opens, closes, self.vector_size)
+
+        head = len(candles_df) - 1
+        head_balance, status = run_strategy(opens[:head], closes[:head], vectors[:head], self.purchase_coef_limit, self.part_of_sell_limit, self.comission, status)
+        last_balance, _ = run_strategy(opens[head:], closes[head:], vectors[head:], self.purchase_coef_limit, self.part_of_sell_limit, self.comission, status)
+
+        candles_df = candles_df.assign(vector = vectors, balance = np.concatenate((head_balance, last_balance)))
+        candles_df = pd.concat([held_df, candles_df[held_df.columns]]) if len(held_df) else candles_df
+        candles_df = candles_df.iloc[int(candles_df.index.values.searchsorted(start_ms)):]
+
+        extended = copy.copy(self)
+        extended.df = candles_df
+        extended.end_ms = end_ms
+        extended.version = self.version + 1
+        extended.__status = status
+        extended.__returns = (list(returns) + list(new_returns[:head]))[-self.vector_size:] if self.vector_size else []
+        return extended
+
+#Конец окна, выровненный вверх по границе свечи: окна, запрошенные в пределах одной свечи, совпадают
+def align_end_datetime(candle_interval, end_datetime):
+    duration = candle_durations[candle_interval]
+    end_ms = -(-int(end_datetime.timestamp() * 1000) // duration) * duration
+    return datetime.fromtimestamp(end_ms / 1000, pytz.UTC)
+
+#Рассчитать набор данных графика (progress - необязательная функция, получающая процент выполнения после загрузки свечей).
+#Одинаковые наборы (акция, интервал свечи, окно, размер вектора) рассчитываются один раз: одновременные запросы
+#ждут первого, результат хранится в кэше на диске ttl секунд (по умолчанию FLIGHT_RESULT_TTL).
+@metrics.timed("stage")
+def build_dataset(figi, candle_interval, time_interval, end_datetime, vector_size, progress = None, ttl = None):
+    end_datetime = align_end_datetime(candle_interval, end_datetime)
+    start_ms = int((end_datetime - time_interval).timestamp() * 1000)
+    end_ms = int(end_datetime.timestamp() * 1000)
+    key = f"dataset:{figi}:{int(candle_interval)}:{start_ms}:{end_ms}:{vector_size}"
+
+    def compute():
+        dataset = dataset_disk_cache.get(key)
+        if dataset is not None: return dataset
+
+        candles_df = get_candles_df(figi, candle_interval, time_interval, end_datetime)
+        metrics.observe("dataset_candles", CandleInterval(candle_interval).name, len(candles_df))
+        if progress is not None: progress(50)
+        dataset = Dataset(figi, candle_interval, end_ms, vector_size, candles_df)
+        dataset_disk_cache.set(key, dataset, expire = FLIGHT_RESULT_TTL if ttl is None else ttl)
+        return dataset
+
+    return single_flight.run(key, compute)
+
+#Обновить набор данных до окна, заканчивающегося в end_datetime: загружаются только свечи после последней имеющейся.
+#Если окно не пересекается с набором или параметры набора отличаются, набор рассчитывается заново.
+@metrics.timed("stage")
+def refresh_dataset(dataset, figi, candle_interval, time_interval, end_datetime, vector_size, progress = None):
+    end_datetime = align_end_datetime(candle_interval, end_datetime)
+    start_ms = int((end_datetime - time_interval).timestamp() * 1000)
+    end_ms = int(end_datetime.timestamp() * 1000)
+
+    is_same = dataset is not None and (dataset.figi, dataset.candle_interval, dataset.vector_size) == (figi, candle_interval, vector_size)
+    if not (is_same and len(dataset.df) and start_ms <= dataset.df.index[-1] < end_ms and end_ms >= dataset.end_ms):
+        return build_dataset(figi, candle_interval, time_interval, end_datetime, vector_size, progress)
+
+    candles_df = get_candles_range_df(figi, candle_interval, int(dataset.df.index[-1]), end_ms)
+    if progress is not None: progress(50)
+    return dataset.extend(candles_df, start_ms, end_ms)
+
+#Сохранить набор данных в кэше и получить его идентификатор
+def put_dataset(dataset):
+    dataset_id = uuid.uuid4().hex
+    dataset_cache.put(dataset_id, dataset)
+    dataset_disk_cache.set(dataset_id, dataset)
+    return dataset_id
+
+#Закрепить набор данных в памяти процесса (на время подписки на свечи)
+def pin_dataset(dataset_id, dataset):
+    pinned_datasets[dataset_id] = dataset
+
+def unpin_dataset(dataset_id):
+    pinned_datasets.pop(dataset_id, None)
 
+#Получить набор данных по идентификатору (None, если он вытеснен из кэша)
+def get_dataset(dataset_id):
+    if not dataset_id: return None
+    dataset = pinned_datasets.get(dataset_id)
+    if dataset is None: dataset = dataset_cache.get(dataset_id)
+    if dataset is None:
+        dataset = dataset_disk_cache.get(dataset_id)
+        if dataset is not None: dataset_cache.put(dataset_id, dataset)
+    return dataset
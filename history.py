@@ -0,0 +1,215 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+import dotenv
+import numpy as np
+import pandas as pd
+import pytz
+
+import functions
+import metrics
+
+dotenv.load_dotenv()
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_CHUNK_SIZE = int(os.getenv("HISTORY_CHUNK_SIZE", 1 << 18))
+HISTORY_FETCH_DAYS = int(os.getenv("HISTORY_FETCH_DAYS", 30))
+
+#Колонки файлов истории и их типы
+history_columns = {"time": np.int64, "open": np.float64, "close": np.float64}
+
+#Границы корзин гистограммы положительных векторов (в процентах) для процентиля без загрузки всех векторов
+quantile_edges = np.logspace(-8, 4, 1 << 16)
+
+
+#История свечей акции в колоночных файлах каталога path/<figi>_<interval>: по файлу на колонку и meta.json
+#с количеством свечей и концом загруженного промежутка. Файлы дописываются и читаются через np.memmap,
+#поэтому в памяти находятся только используемые страницы.
+class HistoryStore():
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+
+    def __dir(self, figi, candle_interval):
+        return os.path.join(self.__path, f"{figi}_{int(candle_interval)}")
+
+    def get_meta(self, figi, candle_interval):
+        path = os.path.join(self.__dir(figi, candle_interval), "meta.json")
+        if not os.path.exists(path): return {"count": 0, "end_ms": None}
+        with open(path) as file: return json.load(file)
+
+    #Дописать свечи (колонки history_columns) и отметить промежуток до end_ms как загруженный
+    def append(self, figi, candle_interval, columns, end_ms):
+        directory = self.__dir(figi, candle_interval)
+        os.makedirs(directory, exist_ok = True)
+        with self.__lock:
+            meta = self.get_meta(figi, candle_interval)
+            for column, dtype in history_columns.items():
+                with open(os.path.join(directory, f"{column}.bin"), "ab") as file:
+                    #Данные, записанные после последнего сохранения meta.json (прерванная запись), отбрасываются
+                    file.truncate(meta["count"] * np.dtype(dtype).itemsize)
+                    np.ascontiguousarray(columns[column], dtype = dtype).tofile(file)
+
+            meta = {"count": meta["count"] + len(columns["time"]), "end_ms": int(end_ms)}
+            with open(os.path.join(directory, "meta.tmp"), "w") as file: json.dump(meta, file)
+            os.replace(os.path.join(directory, "meta.tmp"), os.path.join(directory, "meta.json"))
+
+    #Колонки истории только для чтения
+    def arrays(self, figi, candle_interval):
+        count = self.get_meta(figi, candle_interval)["count"]
+        if not count: return {column: np.empty(0, dtype = dtype) for column, dtype in history_columns.items()}
+
+        directory = self.__dir(figi, candle_interval)
+        return {column: np.memmap(os.path.join(directory, f"{column}.bin"), dtype = dtype, mode = "r", shape = (count,)) for column, dtype in history_columns.items()}
+
+
+history_store = HistoryStore(HISTORY_DIR)
+
+#Догрузить историю свечей акции от first_1min_candle_date (или от конца загруженной) до текущего момента.
+#Свечи загружаются промежутками по HISTORY_FETCH_DAYS дней, в памяти находится только один промежуток.
+#Формирующаяся свеча не сохраняется. progress - необязательная функция, получающая процент выполнения.
+#Загрузка может идти дольше FLIGHT_TIMEOUT, поэтому блокировка не истекает по времени.
+@metrics.timed("stage")
+def sync_history(figi, candle_interval, progress = None):
+    with functions.single_flight.lock(f"history:{figi}:{int(candle_interval)}", expiring = False):
+        duration = functions.candle_durations[candle_interval]
+        now_ms = int(datetime.now(pytz.UTC).timestamp() * 1000)
+        first_ms = int(functions.get_share(figi).first_1min_candle_date.timestamp() * 1000)
+        start_ms = history_store.get_meta(figi, candle_interval)["end_ms"] or first_ms
+        step_ms = HISTORY_FETCH_DAYS * 24 * 3600 * 1000
+
+        while start_ms < now_ms - duration:
+            end_ms = min(start_ms + step_ms, now_ms)
+            with metrics.timer("api", "get_all_candles"), functions.client_pool.client() as client:
+                candles = client.get_all_candles(
+                    figi = figi,
+                    from_ = datetime.fromtimestamp(start_ms / 1000, pytz.UTC),
+                    to = datetime.fromtimestamp(end_ms / 1000, pytz.UTC),
+                    interval = candle_interval
+                )
+                columns, incomplete_time = functions.collect_candles(candles, min(step_ms // duration + 1, 1 << 16))
+
+            covered_end = min(end_ms, now_ms - duration)
+            if incomplete_time is not None: covered_end = min(covered_end, incomplete_time)
+            prices = functions.columns_to_prices(columns)
+            is_covered = (prices["time"] >= start_ms) & (prices["time"] < covered_end)
+            history_store.append(figi, candle_interval, {column: prices[column][is_covered] for column in history_columns}, covered_end)
+            metrics.observe("api_candles", "get_all_candles", len(columns["time"]))
+
+            if progress is not None: progress(int((covered_end - first_ms) / max(now_ms - first_ms, 1) * 100))
+            if covered_end <= start_ms: break
+            start_ms = covered_end
+
+    return history_store.arrays(figi, candle_interval)
+
+
+#Прогнать стратегию по свечам [start, end) колонок истории блоками по chunk_size свечей.
+#Между блоками переносятся состояние стратегии и доходности окна вектора, доходности перед start берутся из истории.
+#Возвращает состояние стратегии на конец и итоги диапазона (баланс на конец, максимальная просадка).
+def run_chunked(arrays, start, end, vector_size, purchase_coef_limit, part_of_sell_limit, comission, status = None, chunk_size = HISTORY_CHUNK_SIZE):
+    opens, closes = arrays["open"], arrays["close"]
+    warmup = max(start - vector_size, 0)
+    returns = closes[warmup:start] / opens[warmup:start] - 1
+    balance = status["balance"] if status else 1
+    peak, drawdown = balance, 0.0
+
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        chunk_opens = np.asarray(opens[chunk_start:chunk_end])
+        chunk_closes = np.asarray(closes[chunk_start:chunk_end])
+
+        vectors = functions.calc_next_vectors(returns, chunk_opens, chunk_closes, vector_size)
+        balance_history, status = functions.run_strategy(chunk_opens, chunk_closes, vectors, purchase_coef_limit, part_of_sell_limit, comission, status)
+        returns = np.concatenate((returns, chunk_closes / chunk_opens - 1))[-vector_size:] if vector_size else returns[:0]
+
+        peaks = np.maximum(np.maximum.accumulate(balance_history), peak)
+        drawdown = max(drawdown, float(((peaks - balance_history) / peaks).max()))
+        peak, balance = float(peaks[-1]), float(balance_history[-1])
+
+    status = dict(status) if status else functions.get_initial_status()
+    return status, {"balance": balance, "drawdown": drawdown}
+
+#Порог покупки (процентиль положительных векторов) на свечах [start, end) без загрузки всех векторов.
+#Диапазон, помещающийся в один блок, считается точно. Для большего диапазона вектора блоков накапливаются
+#в гистограмме с логарифмическими корзинами, процентиль интерполируется внутри корзины.
+def get_chunked_purchase_coef_limit(arrays, start, end, vector_size, percentile = 90, chunk_size = HISTORY_CHUNK_SIZE):
+    opens, closes = arrays["open"], arrays["close"]
+    warmup = max(start - vector_size, 0)
+    returns = closes[warmup:start] / opens[warmup:start] - 1
+    if end - start <= chunk_size:
+        vectors = functions.calc_next_vectors(returns, np.asarray(opens[start:end]), np.asarray(closes[start:end]), vector_size)
+        return float(functions.get_purchase_coef_limit(vectors, percentile)) if (vectors > 0).any() else np.inf
+
+    counts = np.zeros(len(quantile_edges) + 1, dtype = np.int64)
+
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        chunk_opens = np.asarray(opens[chunk_start:chunk_end])
+        chunk_closes = np.asarray(closes[chunk_start:chunk_end])
+
+        vectors = functions.calc_next_vectors(returns, chunk_opens, chunk_closes, vector_size)
+        counts += np.bincount(np.searchsorted(quantile_edges, vectors[vectors > 0]), minlength = len(counts))
+        returns = np.concatenate((returns, chunk_closes / chunk_opens - 1))[-vector_size:] if vector_size else returns[:0]
+
+    total = counts.sum()
+    if not total: return np.inf
+
+    #Корзина, в которую попадает процентиль, и доля внутри нее
+    rank = percentile / 100 * total
+    cumulative = np.cumsum(counts)
+    position = min(int(np.searchsorted(cumulative, rank)), len(quantile_edges) - 1)
+    lower = quantile_edges[position - 1] if position else 0
+    share = (rank - (cumulative[position - 1] if position else 0)) / max(counts[position], 1)
+    return float(lower + (quantile_edges[position] - lower) * min(max(share, 0), 1))
+
+#Бэктест по всей загруженной истории: порог покупки по всей истории, стратегия - блоками
+@metrics.timed("stage")
+def run_history_backtest(figi, candle_interval, vector_size, percentile = 90, part_of_sell_limit = 0, comission = 0.0003, chunk_size = HISTORY_CHUNK_SIZE):
+    arrays = history_store.arrays(figi, candle_interval)
+    count = len(arrays["time"])
+    purchase_coef_limit = get_chunked_purchase_coef_limit(arrays, 0, count, vector_size, percentile, chunk_size)
+    status, summary = run_chunked(arrays, 0, count, vector_size, purchase_coef_limit, part_of_sell_limit, comission, chunk_size = chunk_size)
+    return {"candles": count, "purchase_coef_limit": purchase_coef_limit, "trades": status["trades"], **summary}
+
+#Walk-forward: история делится на тестовые окна длиной test_interval, порог покупки каждого окна считается
+#по предшествующему окну обучения train_interval. Состояние стратегии переносится между окнами, баланс накопительный.
+#Память не зависит от длины истории: границы окон ищутся бинарным поиском по файлу времени, свечи читаются блоками.
+@metrics.timed("stage")
+def walk_forward(figi, candle_interval, vector_size, train_interval, test_interval, percentile = 90, part_of_sell_limit = 0, comission = 0.0003, chunk_size = HISTORY_CHUNK_SIZE, progress = None):
+    arrays = history_store.arrays(figi, candle_interval)
+    times = arrays["time"]
+    if not len(times): return pd.DataFrame(columns = ["start", "end", "candles", "purchase_coef_limit", "balance", "return", "trades", "drawdown"])
+
+    first = datetime.fromtimestamp(times[0] / 1000, pytz.UTC)
+    last_ms = int(times[-1]) + functions.candle_durations[candle_interval]
+    window_starts = []
+    window_start = first + train_interval
+    while int(window_start.timestamp() * 1000) < last_ms:
+        window_starts.append(window_start)
+        window_start += test_interval
+
+    status = None
+    rows = []
+    for number, window_start in enumerate(window_starts):
+        train_start, test_start, test_end = [int(times.searchsorted(int(moment.timestamp() * 1000))) for moment in [window_start - train_interval, window_start, window_start + test_interval]]
+        if test_start == test_end: continue
+
+        purchase_coef_limit = get_chunked_purchase_coef_limit(arrays, train_start, test_start, vector_size, percentile, chunk_size)
+        start_balance = status["balance"] if status else 1
+        start_trades = status["trades"] if status else 0
+        status, summary = run_chunked(arrays, test_start, test_end, vector_size, purchase_coef_limit, part_of_sell_limit, comission, status, chunk_size)
+
+        rows.append({
+            "start": int(times[test_start]),
+            "end": int(times[test_end - 1]),
+            "candles": test_end - test_start,
+            "purchase_coef_limit": purchase_coef_limit,
+            "balance": summary["balance"],
+            "return": summary["balance"] - start_balance,
+            "trades": status["trades"] - start_trades,
+            "drawdown": summary["drawdown"],
+        })
+        if progress is not None: progress(int((number + 1) / len(window_starts) * 100))
+
+    return pd.DataFrame(rows, columns = ["start", "end", "candles", "purchase_coef_limit", "balance", "return", "trades", "drawdown"])
@@ -0,0 +1,54 @@
+import os
+import time
+import functools
+from contextlib import contextmanager
+
+import dotenv
+import diskcache
+from dash import DiskcacheManager
+from dash.exceptions import PreventUpdate
+
+import metrics
+
+dotenv.load_dotenv()
+JOB_CACHE_DIR = os.getenv("JOB_CACHE_DIR", "jobs_cache")
+USER_JOBS = int(os.getenv("USER_JOBS", 2))
+JOB_WAIT_TIMEOUT = float(os.getenv("JOB_WAIT_TIMEOUT", 60))
+
+#Фоновые обратные вызовы выполняются в отдельных процессах, результаты и ход выполнения передаются через кэш на диске.
+#Задача, запущенная повторно тем же обратным вызовом, завершает предыдущую (устаревшую) задачу этого пользователя.
+#Метрики процессов задач пересылаются процессу сервера через metrics.registry.forward.
+class JobManager(DiskcacheManager):
+    def call_job_fn(self, key, job_fn, args, context):
+        return super().call_job_fn(key, functools.partial(run_job, job_fn), args, context)
+
+#Выполнить функцию задачи в ее процессе
+def run_job(job_fn, *args):
+    metrics.registry.forward()
+    return job_fn(*args)
+
+
+job_cache = diskcache.Cache(JOB_CACHE_DIR)
+manager = JobManager(job_cache)
+
+
+#Слот фоновой задачи пользователя: одновременно выполняется не больше USER_JOBS задач на сессию, остальные ждут.
+#Слоты хранятся как pid процессов задач, слоты принудительно завершенных задач освобождаются при следующей проверке.
+@contextmanager
+def job_slot(sid, timeout = JOB_WAIT_TIMEOUT):
+    key = f"jobs:{sid}"
+    pid = os.getpid()
+    deadline = time.monotonic() + timeout
+    while True:
+        with job_cache.transact():
+            pids = [job_pid for job_pid in job_cache.get(key, []) if manager.job_running(job_pid)]
+            if len(pids) < USER_JOBS:
+                job_cache.set(key, pids + [pid], expire = 24 * 3600)
+                break
+        if time.monotonic() > deadline: raise PreventUpdate
+        time.sleep(0.1)
+
+    try: yield
+    finally:
+        with job_cache.transact():
+            job_cache.set(key, [job_pid for job_pid in job_cache.get(key, []) if job_pid != pid], expire = 24 * 3600)
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+
+import dotenv
+import pytz
+
+from tinkoff.invest import CandleInstrument, CandleInterval, SubscriptionInterval
+
+import replay
+import functions
+import metrics
+
+dotenv.load_dotenv()
+LIVE_INTERVAL = int(os.getenv("LIVE_INTERVAL", 5000))
+LIVE_EXPIRE_INTERVALS = int(os.getenv("LIVE_EXPIRE_INTERVALS", 24))
+
+#Интервалы подписки на свечи для интервалов исторических свечей
+subscription_intervals = {
+    CandleInterval.CANDLE_INTERVAL_1_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
+    CandleInterval.CANDLE_INTERVAL_2_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_2_MIN,
+    CandleInterval.CANDLE_INTERVAL_3_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_3_MIN,
+    CandleInterval.CANDLE_INTERVAL_5_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_FIVE_MINUTES,
+    CandleInterval.CANDLE_INTERVAL_15_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_FIFTEEN_MINUTES,
+    CandleInterval.CANDLE_INTERVAL_30_MIN: SubscriptionInterval.SUBSCRIPTION_INTERVAL_30_MIN,
+    CandleInterval.CANDLE_INTERVAL_HOUR: SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_HOUR,
+    CandleInterval.CANDLE_INTERVAL_2_HOUR: SubscriptionInterval.SUBSCRIPTION_INTERVAL_2_HOUR,
+    CandleInterval.CANDLE_INTERVAL_4_HOUR: SubscriptionInterval.SUBSCRIPTION_INTERVAL_4_HOUR,
+}
+candle_intervals = {subscription_interval: candle_interval for candle_interval, subscription_interval in subscription_intervals.items()}
+
+
+#Свечи в реальном времени.
+#Один поток рыночных данных на процесс; подписка на (figi, интервал) держится, пока на нее подписан хотя бы один набор данных.
+#Каждая свеча из потока дописывается во все подписанные наборы данных через Dataset.apply_candle.
+#Подписанные наборы закреплены в памяти (functions.pin_dataset), поэтому functions.get_dataset возвращает дополняемый объект.
+#Подписка набора данных, который не опрашивался дольше expire секунд (вкладка закрыта), снимается.
+class LiveCandles():
+    def __init__(self, reconnect_delay = 5, expire = LIVE_INTERVAL * LIVE_EXPIRE_INTERVALS / 1000):
+        self.__reconnect_delay = reconnect_delay
+        self.__expire = expire
+        self.__lock = threading.Lock()
+        self.__datasets = {}
+        self.__polled = {}
+        self.__stream = None
+        self.__thread = None
+
+    def __instrument(self, key):
+        return CandleInstrument(figi = key[0], interval = subscription_intervals[key[1]])
+
+    def __run(self):
+        while True:
+            try:
+                with functions.client_pool.client() as client:
+                    stream = client.create_market_data_stream()
+                    with self.__lock:
+                        self.__stream = stream
+                        if self.__datasets: stream.candles.subscribe([self.__instrument(key) for key in self.__datasets])
+
+                    for marketdata in stream:
+                        if marketdata.candle: self.__on_candle(marketdata.candle)
+            except Exception as error:
+                metrics.registry.count_error("api_seconds", "market_data_stream")
+                print(f"Поток свечей прерван: {error}")
+            finally:
+                with self.__lock: self.__stream = None
+
+            time.sleep(self.__reconnect_delay)
+
+    #Отписать наборы данных (вызывается под блокировкой)
+    def __remove(self, dataset_ids):
+        for dataset_id in dataset_ids:
+            self.__polled.pop(dataset_id, None)
+            functions.unpin_dataset(dataset_id)
+        for key in list(self.__datasets):
+            for dataset_id in dataset_ids: self.__datasets[key].pop(dataset_id, None)
+            if self.__datasets[key]: continue
+
+            del self.__datasets[key]
+            if self.__stream is not None: self.__stream.candles.unsubscribe([self.__instrument(key)])
+
+    #Снять подписки, которые давно не опрашивались (вызывается под блокировкой)
+    def __expire_polled(self):
+        now = time.monotonic()
+        self.__remove([dataset_id for dataset_id, polled in self.__polled.items() if now - polled > self.__expire])
+
+    def __on_candle(self, candle):
+        key = (candle.figi, candle_intervals.get(candle.interval))
+        with self.__lock:
+            self.__expire_polled()
+            datasets = list(self.__datasets.get(key, {}).values())
+
+        time_ms = int(candle.time.astimezone(pytz.UTC).timestamp() * 1000)
+        candle_data = {
+            "time": time_ms,
+            "open": functions.quotation_to_float(candle.open),
+            "high": functions.quotation_to_float(candle.high),
+            "low": functions.quotation_to_float(candle.low),
+            "close": functions.quotation_to_float(candle.close),
+            "volume": candle.volume,
+        }
+        for dataset in datasets: dataset.apply_candle(candle_data)
+
+    #Подписать набор данных на свечи его акции и интервала.
+    #При воспроизведении записанных ответов (INVEST_TRANSPORT=replay) потока рыночных данных нет, подписка не выполняется.
+    def subscribe(self, dataset_id, dataset):
+        if replay.INVEST_TRANSPORT == "replay": return False
+        if dataset.candle_interval not in subscription_intervals: return False
+
+        key = (dataset.figi, dataset.candle_interval)
+        with self.__lock:
+            self.__expire_polled()
+            is_new = key not in self.__datasets
+            self.__datasets.setdefault(key, {})[dataset_id] = dataset
+            self.__polled[dataset_id] = time.monotonic()
+            functions.pin_dataset(dataset_id, dataset)
+            if is_new and self.__stream is not None: self.__stream.candles.subscribe([self.__instrument(key)])
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(target = self.__run, daemon = True)
+                self.__thread.start()
+
+        return True
+
+    #Отметить опрос набора данных. Возвращает False, если его подписка уже снята.
+    def touch(self, dataset_id):
+        with self.__lock:
+            if dataset_id not in self.__polled: return False
+            self.__polled[dataset_id] = time.monotonic()
+            return True
+
+    #Отписать набор данных
+    def unsubscribe(self, dataset_id):
+        with self.__lock: self.__remove([dataset_id])
+
+
+live_candles = LiveCandles()
@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import bisect
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+import dotenv
+import diskcache
+from dash.exceptions import PreventUpdate
+from flask import Response, g, request
+from flask.sessions import SecureCookieSessionInterface
+
+dotenv.load_dotenv()
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "t_investments")
+METRICS_PROFILING = os.getenv("METRICS_PROFILING", "0") == "1"
+METRICS_PROFILE_DIR = os.getenv("METRICS_PROFILE_DIR", "profiles")
+METRICS_SPOOL_DIR = os.getenv("METRICS_SPOOL_DIR", "metrics_spool")
+METRICS_SPOOL_SIZE = int(os.getenv("METRICS_SPOOL_SIZE", 100000))
+
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+size_buckets = [1 << power for power in range(10, 27, 2)]
+count_buckets = [10 ** power for power in range(0, 7)]
+
+#Гистограммы: имя -> (описание, имя метки, границы корзин)
+metric_families = {
+    "callback_seconds": ("Время выполнения обратных вызовов Dash", "callback", latency_buckets),
+    "request_seconds": ("Время обработки запроса обратного вызова вместе с сериализацией ответа", "callback", latency_buckets),
+    "response_bytes": ("Размер ответа обратного вызова", "callback", size_buckets),
+    "api_seconds": ("Время вызовов API", "call", latency_buckets),
+    "api_candles": ("Количество свечей в ответе API", "call", count_buckets),
+    "stage_seconds": ("Время этапов расчета", "stage", latency_buckets),
+    "dataset_candles": ("Количество свечей в наборе данных", "interval", count_buckets),
+}
+
+
+#Гистограмма в формате Prometheus: количество наблюдений по корзинам, сумма и количество
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+#Потокобезопасный набор гистограмм и счетчиков ошибок.
+#Процессы фоновых задач не отдают /metrics: после forward() их наблюдения пишутся в очередь на диске spool,
+#а процесс сервера переносит их в свои гистограммы при формировании ответа.
+class MetricsRegistry():
+    def __init__(self, families, spool):
+        self.__families = families
+        self.__spool = spool
+        self.__forward_pid = None
+        self.__lock = threading.Lock()
+        self.__histograms = {name: {} for name in families}
+        self.__errors = {}
+
+    #Пересылать наблюдения текущего процесса в очередь (дочерние процессы-обработчики не пересылают)
+    def forward(self):
+        self.__forward_pid = os.getpid()
+
+    def __is_forwarding(self):
+        return self.__forward_pid == os.getpid()
+
+    def __observe(self, family, label, value):
+        histograms = self.__histograms[family]
+        if label not in histograms: histograms[label] = Histogram(self.__families[family][2])
+        histograms[label].observe(value)
+
+    def __count_error(self, family, label):
+        self.__errors[(family, label)] = self.__errors.get((family, label), 0) + 1
+
+    def observe(self, family, label, value):
+        if self.__is_forwarding(): self.__spool.append(("observe", family, label, value))
+        else:
+            with self.__lock: self.__observe(family, label, value)
+
+    def count_error(self, family, label):
+        if self.__is_forwarding(): self.__spool.append(("error", family, label, None))
+        else:
+            with self.__lock: self.__count_error(family, label)
+
+    #Перенести наблюдения фоновых задач из очереди (вызывается под блокировкой)
+    def __drain(self):
+        while True:
+            try: kind, family, label, value = self.__spool.popleft()
+            except IndexError: return
+            if family not in self.__families: continue
+            if kind == "observe": self.__observe(family, label, value)
+            else: self.__count_error(family, label)
+
+    #Текстовый формат экспозиции Prometheus
+    def render(self):
+        lines = []
+        with self.__lock:
+            self.__drain()
+            for family, (description, label_name, buckets) in self.__families.items():
+                name = f"{METRICS_PREFIX}_{family}"
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                for label, histogram in sorted(self.__histograms[family].items()):
+                    cumulative = 0
+                    for bound, count in zip(buckets + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label_name}="{label}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{label_name}="{label}"}} {histogram.count}')
+
+            name = f"{METRICS_PREFIX}_errors_total"
+            lines += [f"# HELP {name} Количество исключений в замеряемых вызовах", f"# TYPE {name} counter"]
+            for (family, label), count in sorted(self.__errors.items()):
+                lines.append(f'{name}{{family="{family}",name="{label}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(metric_families, diskcache.Deque(directory = METRICS_SPOOL_DIR, maxlen = METRICS_SPOOL_SIZE))
+
+def observe(family, label, value):
+    registry.observe(family, label, value)
+
+#Замерить время блока в гистограмме <kind>_seconds
+@contextmanager
+def timer(kind, label):
+    start = time.perf_counter()
+    try: yield
+    except PreventUpdate: raise
+    except Exception:
+        registry.count_error(f"{kind}_seconds", label)
+        raise
+    finally: registry.observe(f"{kind}_seconds", label, time.perf_counter() - start)
+
+#Декоратор: замерять время вызовов функции в гистограмме <kind>_seconds с меткой - именем функции
+def timed(kind):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(kind, function.__name__): return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#Сессия Flask с замером чтения и записи cookie
+class TimedSessionInterface(SecureCookieSessionInterface):
+    def open_session(self, app, request):
+        with timer("stage", "session_open"): return super().open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with timer("stage", "session_save"): return super().save_session(app, session, response)
+
+
+#Имя обратного вызова Dash, к которому относится запрос
+def get_callback_name(dash_app):
+    body = request.get_json(silent = True) or {}
+    callback = dash_app.callback_map.get(body.get("output"), {}).get("callback")
+    return getattr(callback, "__name__", "unknown")
+
+#Подключить сбор метрик к серверу: /metrics, замер запросов обратных вызовов и профилирование запроса
+#(при METRICS_PROFILING=1 запрос с заголовком X-Profile или параметром profile профилируется в METRICS_PROFILE_DIR).
+def init_app(server, dash_app):
+    server.session_interface = TimedSessionInterface()
+
+    @server.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        if METRICS_PROFILING and (request.headers.get("X-Profile") or request.args.get("profile")):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @server.after_request
+    def finish_request(response):
+        profiler = g.pop("profiler", None)
+        if request.path.endswith("_dash-update-component"):
+            callback = get_callback_name(dash_app)
+            observe("request_seconds", callback, time.perf_counter() - g.metrics_start)
+            observe("response_bytes", callback, response.calculate_content_length() or 0)
+        else: callback = re.sub(r"\W+", "_", request.path).strip("_") or "index"
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(METRICS_PROFILE_DIR, exist_ok = True)
+            path = os.path.join(METRICS_PROFILE_DIR, f"{int(time.time() * 1000)}_{callback}.prof")
+            profiler.dump_stats(path)
+            response.headers["X-Profile-File"] = path
+
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(registry.render(), mimetype = "text/plain; version=0.0.4")
@@ -1,27 +1,36 @@
 import dash
 import dash_mantine_components as dmc
-from dash import Input, Output, State, _dash_renderer, ctx, ALL, dcc, MATCH, callback
+from dash import Input, Output, State, _dash_renderer, ctx, ALL, dcc, MATCH, callback, dash_table, Patch
 from dash.exceptions import PreventUpdate
 from dash_iconify import DashIconify
 
-import plotly.figure_factory as ff
+import plotly.graph_objects as go
 
-from flask import session
 
 import os
-import json
+import pytz
 import dotenv
 
 from dateutil.relativedelta import relativedelta
 from datetime import datetime
 
-import pandas as pd
 import numpy as np
 
 from tinkoff.invest import CandleInterval
 
+import jobs
 import functions
+import metrics
+import sessions
+import sweep
+import history
+import screener
+import live
+import replay
+from live import live_candles
 from functions import DeltaString
+from sessions import session_store
+from prefetch import prefetcher
 
 dotenv.load_dotenv()
 TOKEN = os.getenv("INVEST_TOKEN")
@@ -29,6 +38,9 @@ TOKEN = os.getenv("INVEST_TOKEN")
 _dash_renderer._set_react_version("18.2.0")
 dash.register_page(__name__)
 
+#Настройки графика распределения в порядке флажков на странице
+distplot_props = ["rm_outliers", "show_hist", "show_curve", "show_rug"]
+
 chart_props = {
     "standard_values": {
         "1d": {"interval": relativedelta(days = 1), "candle": {"interval": CandleInterval.CANDLE_INTERVAL_1_MIN, "value": "1m"}},
@@ -56,6 +68,11 @@ def layout():
     layout = dmc.Box(
         children = [
             dcc.Interval(id = "load_interval", n_intervals = 0, max_intervals = 1, interval = 1),
+            dcc.Store(id = "session_id"),
+            dcc.Store(id = "dataset_id"),
+            dcc.Store(id = "live_dataset_id"),
+            dcc.Store(id = "live_version"),
+            dcc.Interval(id = "live_interval", interval = live.LIVE_INTERVAL, disabled = True),
             dmc.Box(
                 children = [
                     dmc.Flex(
@@ -67,6 +84,7 @@ def layout():
                             dmc.ActionIcon(id = {"type": "nav_button", "index": "refresh"}, children = DashIconify(icon = "mingcute:refresh-3-fill", width = 20), size = "input-sm"),
                             dmc.ActionIcon(id = {"type": "nav_button", "index": "next"}, children = DashIconify(icon = "mingcute:right-fill", width = 20), size = "input-sm"),
                             dmc.ActionIcon(id = {"type": "nav_button", "index": "last"}, children = DashIconify(icon = "mingcute:arrows-right-fill", width = 20), size = "input-sm"),
+                            dmc.Switch(id = "live_switch", label = "Онлайн", checked = False, disabled = replay.INVEST_TRANSPORT == "replay", pb = 8),
                         ],
                         gap = "md",
                         align = "flex-end"
@@ -93,6 +111,7 @@ def layout():
                 pt = "md",
                 px = "md"
             ),
+            dmc.Progress(id = "chart_progress", value = 0, size = "xs", mx = "md", mt = "xs"),
             dmc.Tabs(
                 children = [
                     dmc.TabsList(
@@ -100,6 +119,9 @@ def layout():
                             dmc.TabsTab("Курс", value = "course", leftSection = DashIconify(icon="mingcute:chart-line-fill")),
                             dmc.TabsTab("Распределение", value = "distribution", leftSection = DashIconify(icon="mingcute:chart-bar-line")),
                             dmc.TabsTab("Корреляция", value = "correlation", leftSection = DashIconify(icon="mingcute:chart-bar-line")),
+                            dmc.TabsTab("Оптимизация", value = "sweep", leftSection = DashIconify(icon="mingcute:grid-line")),
+                            dmc.TabsTab("Скринер", value = "screener", leftSection = DashIconify(icon="mingcute:search-3-line")),
+                            dmc.TabsTab("История", value = "history", leftSection = DashIconify(icon="mingcute:history-line")),
                             dmc.TabsTab("Настройки", value = "settings", leftSection = DashIconify(icon="mingcute:settings-3-line")),
                         ],
                         px = "md",
@@ -152,17 +174,98 @@ def layout():
                     ),
                     dmc.TabsPanel(
                         children = [
-                            dmc.ScatterChart(
-                                id = "corr_chart",
-                                dataKey = {"x": "vector", "y": "delta"},
-                                data = [],
+                            dmc.Box(
+                                children = [
+                                    dcc.Graph(id = "corr_chart"),
+                                    dmc.Table(id = "corr_table", striped = True, highlightOnHover = True),
+                                ],
                                 pt = "md",
                                 px = "md",
-                                h = 700
                             ),
                         ],
                         value = "correlation"
                     ),
+                    dmc.TabsPanel(
+                        children = [
+                            dmc.Button(id = "sweep_button", children = "Перебрать параметры", leftSection = DashIconify(icon = "mingcute:play-fill"), w = 250),
+                            dcc.Loading(
+                                children = [
+                                    dcc.Graph(id = "sweep_chart"),
+                                    dmc.Table(id = "sweep_table", striped = True, highlightOnHover = True),
+                                ],
+                            ),
+                        ],
+                        value = "sweep",
+                        pt = "md",
+                        px = "md"
+                    ),
+                    dmc.TabsPanel(
+                        children = [
+                            dmc.Button(id = "screener_button", children = "Проверить все акции", leftSection = DashIconify(icon = "mingcute:play-fill"), w = 250),
+                            dcc.Loading(
+                                children = [
+                                    dash_table.DataTable(
+                                        id = "screener_table",
+                                        columns = [
+                                            {"name": "Тикер", "id": "ticker"},
+                                            {"name": "Название", "id": "name"},
+                                            {"name": "Свечи", "id": "candles", "type": "numeric"},
+                                            {"name": "Баланс", "id": "balance", "type": "numeric", "format": {"specifier": ".4f"}},
+                                            {"name": "Сделки", "id": "trades", "type": "numeric"},
+                                            {"name": "Просадка", "id": "drawdown", "type": "numeric", "format": {"specifier": ".2%"}},
+                                            {"name": "Ошибка", "id": "error"},
+                                        ],
+                                        data = [],
+                                        sort_action = "native",
+                                        page_size = 50,
+                                        style_cell = {"fontFamily": "inherit", "textAlign": "left"},
+                                        style_data_conditional = [{"if": {"filter_query": "{error} is not blank"}, "color": "crimson"}],
+                                    ),
+                                ],
+                            ),
+                        ],
+                        value = "screener",
+                        pt = "md",
+                        px = "md"
+                    ),
+                    dmc.TabsPanel(
+                        children = [
+                            dmc.Group(
+                                children = [
+                                    dmc.NumberInput(id = "history_train_days", label = "Окно обучения, дней", value = 90, min = 1, allowDecimal = False, w = 200),
+                                    dmc.NumberInput(id = "history_test_days", label = "Окно проверки, дней", value = 30, min = 1, allowDecimal = False, w = 200),
+                                    dmc.Button(id = "history_button", children = "Проверить на всей истории", leftSection = DashIconify(icon = "mingcute:play-fill"), w = 250),
+                                ],
+                                align = "flex-end",
+                            ),
+                            dmc.Progress(id = "history_progress", value = 0, size = "xs", mt = "xs"),
+                            dcc.Loading(
+                                children = [
+                                    dmc.Text(id = "history_summary", pt = "md"),
+                                    dcc.Graph(id = "history_chart"),
+                                    dash_table.DataTable(
+                                        id = "history_table",
+                                        columns = [
+                                            {"name": "Начало", "id": "start"},
+                                            {"name": "Конец", "id": "end"},
+                                            {"name": "Свечи", "id": "candles", "type": "numeric"},
+                                            {"name": "Порог покупки", "id": "purchase_coef_limit", "type": "numeric", "format": {"specifier": ".4f"}},
+                                            {"name": "Баланс", "id": "balance", "type": "numeric", "format": {"specifier": ".4f"}},
+                                            {"name": "Доходность", "id": "return", "type": "numeric", "format": {"specifier": ".4f"}},
+                                            {"name": "Сделки", "id": "trades", "type": "numeric"},
+                                            {"name": "Просадка", "id": "drawdown", "type": "numeric", "format": {"specifier": ".2%"}},
+                                        ],
+                                        data = [],
+                                        page_size = 50,
+                                        style_cell = {"fontFamily": "inherit", "textAlign": "left"},
+                                    ),
+                                ],
+                            ),
+                        ],
+                        value = "history",
+                        pt = "md",
+                        px = "md"
+                    ),
                     dmc.TabsPanel(
                         children = [
                             dmc.Text(children = "Общие", fz = "h3", fw = 500, pb = "md"),
@@ -222,6 +325,7 @@ def layout():
             "standard_candles": Output("standard_candles", "checked"),
             "distplot_props": Output({"category": "dist_chart_props", "index": ALL}, "checked")
         },
+        "session_id": Output("session_id", "data"),
     },
     inputs = {
         "input": {
@@ -230,8 +334,8 @@ def layout():
     },
     prevent_initial_call = True
 )
+@metrics.timed("callback")
 def initial_callback(input):
-    session.clear()
     output = {}
     output["select_data"] = {}
     output["select_data"]["share"] = functions.get_share_selectdata()
@@ -259,37 +363,21 @@ def initial_callback(input):
         {"label": "Отрицательные", "value": "negative"},
     ]
 
-    if not "data" in session:
-        session_data = {}
-
-        session_data["select_values"] = {}
-        session_data["select_values"]["share"] = output["select_data"]["share"][0]["value"]
-        session_data["select_values"]["interval"] = "1m"
-        session_data["select_values"]["candle"] = "30m"
-        session_data["select_values"]["vector_vals"] = "all"
-        session_data["select_values"]["vector_size"] = 1
-
-        session_data["distplot_props"] = {}
-        session_data["distplot_props"]["rm_outliers"] = False
-        session_data["distplot_props"]["show_hist"] = True
-        session_data["distplot_props"]["show_curve"] = True
-        session_data["distplot_props"]["show_rug"] = True
-
-        session_data["standard_candles"] = True
-    else: session_data = json.loads(session["data"])
+    #Настройки сбрасываются к значениям по умолчанию при загрузке страницы.
+    #Идентификатор сессии передается в фоновые задачи, которые выполняются вне запроса.
+    output["session_id"] = sessions.get_sid()
+    settings = session_store.reset_settings(output["session_id"], share = output["select_data"]["share"][0]["value"])
 
     output["checkbox_states"] = {}
-    output["checkbox_states"]["standard_candles"] = session_data["standard_candles"]
-    output["checkbox_states"]["distplot_props"] = [session_data["distplot_props"][key] for key in session_data["distplot_props"]]
+    output["checkbox_states"]["standard_candles"] = settings.standard_candles
+    output["checkbox_states"]["distplot_props"] = [getattr(settings, key) for key in distplot_props]
 
     output["select_values"] = {}
-    output["select_values"]["share"] = session_data["select_values"]["share"]
-    output["select_values"]["interval"] = session_data["select_values"]["interval"]
-    output["select_values"]["candle"] = session_data["select_values"]["candle"]
-    output["select_values"]["vector_vals"] = session_data["select_values"]["vector_vals"]
-    output["select_values"]["vector_size"] = session_data["select_values"]["vector_size"]
-
-    session["data"] = json.dumps(session_data, cls = functions.NpEncoder)
+    output["select_values"]["share"] = settings.share
+    output["select_values"]["interval"] = settings.interval
+    output["select_values"]["candle"] = settings.candle
+    output["select_values"]["vector_vals"] = settings.vector_vals
+    output["select_values"]["vector_size"] = settings.vector_size
 
     return output
 
@@ -297,6 +385,7 @@ def initial_callback(input):
 @dash.callback(
     output = {
         "price_chart": Output("price_chart", "data"),
+        "dataset_id": Output("dataset_id", "data"),
         "nav_buttons_states": {
             "first": Output({"type": "nav_button", "index": "first"}, "disabled"),
             "prev": Output({"type": "nav_button", "index": "prev"}, "disabled"),
@@ -313,53 +402,106 @@ def initial_callback(input):
                 "vector_size": Input("vector_size", "value"),
             },
             "nav_buttons": Input({"type": "nav_button", "index": ALL}, "n_clicks"),
-            "chart_data": State("price_chart", "data"),
+            "dataset_id": State("dataset_id", "data"),
+            "session_id": State("session_id", "data"),
         }
     },
+    background = True,
+    progress = Output("chart_progress", "value"),
+    progress_default = 0,
+    interval = 250,
     prevent_initial_call = True
 )
-def update_chart_data(input):
+@metrics.timed("callback")
+def update_chart_data(set_progress, input):
     if not (input["select_values"]["share"] and input["select_values"]["interval"]): raise PreventUpdate
 
+    with jobs.job_slot(input["session_id"]):
+        set_progress(10)
+        return get_chart_data_output(set_progress, input)
+
+#Конец окна после нажатия кнопки навигации
+def get_nav_end(button, end_dt, start_dt, dt_now, time_interval):
+    if button in ["refresh", "last"]: return dt_now
+    if button == "first": return start_dt + time_interval
+    if button == "prev": return start_dt + time_interval if end_dt - time_interval < start_dt else end_dt - time_interval
+    if button == "next": return dt_now if end_dt + time_interval > dt_now else end_dt + time_interval
+    return end_dt
+
+#Рассчитать набор данных и данные графика курса (выполняется в фоновой задаче)
+def get_chart_data_output(set_progress, input):
     time_interval = chart_props["standard_values"][input["select_values"]["interval"]]["interval"]
     candle_interval = chart_props["candle_intervals"][input["select_values"]["candle"]]
 
     dt_now = functions.local_to_utc(datetime.now())
     start_dt = functions.get_share(input["select_values"]["share"]).first_1min_candle_date
     end_dt = dt_now
+    current_dataset = None
 
     if isinstance(ctx.triggered_id, dict):
         if ctx.triggered_id["type"] == "nav_button":
             #Обработка нажатий кнопок верхней панели
-            end_dt = functions.local_to_utc(datetime.strptime(input["chart_data"][-1]["datetime"], "%d %b %Y %H:%M"))
-            if ctx.triggered_id["index"] == "refresh": end_dt = dt_now
-            if ctx.triggered_id["index"] == "first": end_dt = start_dt + time_interval
-            if ctx.triggered_id["index"] == "last": end_dt = dt_now
-            if ctx.triggered_id["index"] == "prev": end_dt = start_dt + time_interval if end_dt - time_interval < start_dt else end_dt - time_interval
-            if ctx.triggered_id["index"] == "next": end_dt = dt_now if end_dt + time_interval > dt_now else end_dt + time_interval
-        elif ctx.triggered_id["type"] == "select":
-            #Запись в хранилище сессии значений выпадающих списков
-            session_data = json.loads(session["data"])
-            session_data["select_values"]["share"] = input["select_values"]["share"]
-            session_data["select_values"]["candle"] = input["select_values"]["candle"]
-            session_data["select_values"]["vector_size"] = input["select_values"]["vector_size"]
-            session["data"] = json.dumps(session_data, cls = functions.NpEncoder)
-
-    candles_df = functions.get_candles_df(input["select_values"]["share"], candle_interval, time_interval, end_dt)
-    candles_df["vector"] = functions.get_vectors(candles_df, input["select_values"]["vector_size"])
-
-    positive_vectors = list(candles_df[candles_df["vector"] > 0]["vector"])
-    candles_df["balance"] = functions.get_balance_history(candles_df, np.percentile(positive_vectors, 90), 0, 0.0003)
+            current_dataset = functions.get_dataset(input["dataset_id"])
+            if current_dataset is not None: end_dt = datetime.fromtimestamp(current_dataset.end_ms / 1000, pytz.UTC)
+            end_dt = get_nav_end(ctx.triggered_id["index"], end_dt, start_dt, dt_now, time_interval)
+
+    dataset_args = (input["select_values"]["share"], candle_interval, time_interval, end_dt, input["select_values"]["vector_size"], set_progress)
+    #При обновлении и переходе к последнему окну загружаются только свечи после последней свечи текущего набора
+    if current_dataset is not None and ctx.triggered_id["index"] in ["refresh", "last"]: dataset = functions.refresh_dataset(current_dataset, *dataset_args)
+    else: dataset = functions.build_dataset(*dataset_args)
+    candles_df = dataset.df
+    set_progress(90)
 
     output = {}
+    output["dataset_id"] = functions.put_dataset(dataset)
     output["nav_buttons_states"] = {}
     output["nav_buttons_states"]["next"] = output["nav_buttons_states"]["last"] = bool(end_dt >= dt_now)
     output["nav_buttons_states"]["prev"] = output["nav_buttons_states"]["first"] = bool(end_dt - time_interval <= start_dt)
-    output["price_chart"] = candles_df.to_dict("records")
+    output["price_chart"] = functions.get_chart_data(candles_df)
 
     return output
 
 
+#Запись в хранилище сессии значений выпадающих списков (отдельно от фонового расчета графика)
+@callback(
+    Input({"type": "select", "index": "share"}, "value"),
+    Input({"type": "select", "index": "candle"}, "value"),
+    Input("vector_size", "value"),
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def save_select_values(share, candle, vector_size):
+    sid = sessions.get_sid()
+    session_store.update_settings(sid, share = share, candle = candle, vector_size = vector_size)
+    #Заранее рассчитываемые окна прежней акции или прежних параметров больше не нужны
+    prefetcher.cancel(sid)
+
+
+#Упреждающий расчет предыдущего и следующего окна показанного набора данных (для кнопок навигации)
+@callback(
+    Input("dataset_id", "data"),
+    State({"type": "select", "index": "interval"}, "value"),
+    State("session_id", "data"),
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def prefetch_adjacent_windows(dataset_id, interval, session_id):
+    dataset = functions.get_dataset(dataset_id)
+    if dataset is None or not interval: raise PreventUpdate
+
+    time_interval = chart_props["standard_values"][interval]["interval"]
+    dt_now = functions.local_to_utc(datetime.now())
+    start_dt = functions.get_share(dataset.figi).first_1min_candle_date
+    end_dt = datetime.fromtimestamp(dataset.end_ms / 1000, pytz.UTC)
+
+    windows = []
+    for button in ["prev", "next"]:
+        window_end = get_nav_end(button, end_dt, start_dt, dt_now, time_interval)
+        #Окно, доходящее до текущего момента, меняется с каждой свечой, поэтому заранее не рассчитывается
+        if window_end != end_dt and window_end < dt_now: windows.append((dataset.figi, dataset.candle_interval, time_interval, window_end, dataset.vector_size))
+    prefetcher.submit(session_id, windows)
+
+
 @callback(
     Output("share_price_slider", "max"),
     Output("share_price_slider", "value"),
@@ -367,17 +509,22 @@ def update_chart_data(input):
     Output("price_chart", "rightYAxisProps"),
     Output("price_chart", "referenceLines", allow_duplicate = True),
     
-    Input("price_chart", "data"),
+    Input("dataset_id", "data"),
     State("price_chart", "referenceLines"),
     prevent_initial_call = True
 )
-def update_chart_props(chart_data, referenceLines):
-    slider_max = len(chart_data) - 1
+@metrics.timed("callback")
+def update_chart_props(dataset_id, referenceLines):
+    dataset = functions.get_dataset(dataset_id)
+    if dataset is None or not len(dataset.df): raise PreventUpdate
+    stats = dataset.stats
+
+    slider_max = len(dataset.df) - 1
     slider_value = [0, slider_max]
+    open_min, open_max = stats.get_min("open", 0, slider_max), stats.get_max("open", 0, slider_max)
 
-    df = pd.DataFrame(chart_data)
-    yAxisProps = {"domain": [df["open"].min(), df["open"].max()], "padding": {"top": 20, "bottom": 20}}
-    rightYAxisProps = {"domain": [df["balance"].min(), df["balance"].max()], "padding": {"top": 20, "bottom": 20}}
+    yAxisProps = {"domain": [open_min, open_max], "padding": {"top": 20, "bottom": 20}}
+    rightYAxisProps = {"domain": [stats.get_min("balance", 0, slider_max), stats.get_max("balance", 0, slider_max)], "padding": {"top": 20, "bottom": 20}}
 
     referenceLines_output = []
     if referenceLines:
@@ -385,13 +532,68 @@ def update_chart_props(chart_data, referenceLines):
             if "x" in line: referenceLines_output.append(line)
 
     referenceLines_output += [
-        {"y": df["open"].min(), "label": df["open"].min()},
-        {"y": df["open"].max(), "label": df["open"].max()}
+        {"y": open_min, "label": open_min},
+        {"y": open_max, "label": open_max}
     ]
 
     return slider_max, slider_value, yAxisProps, rightYAxisProps, referenceLines_output
 
 
+#Построить график распределения (гистограмма, KDE, rug) по рассчитанному распределению
+def get_distplot(distribution, show_hist, show_curve, show_rug):
+    color = "rgb(31, 119, 180)"
+    figure = go.Figure()
+    if distribution is not None:
+        if show_hist: figure.add_trace(go.Bar(x = distribution["hist_x"], y = distribution["hist_y"], width = distribution["bin_size"], marker = dict(color = color), opacity = 0.7, name = "vector"))
+        if show_curve: figure.add_trace(go.Scatter(x = distribution["kde_x"], y = distribution["kde_y"], mode = "lines", line = dict(color = color), name = "vector"))
+        if show_rug: figure.add_trace(go.Scatter(
+            x = distribution["rug_x"], y = ["vector"] * len(distribution["rug_x"]), text = distribution["rug_text"],
+            mode = "markers", marker = dict(color = color, symbol = "line-ns-open"), yaxis = "y2", name = "vector"
+        ))
+
+    if show_rug: figure.update_layout(yaxis = dict(domain = [0.35, 1]), yaxis2 = dict(domain = [0, 0.25], anchor = "x1", dtick = 1, showticklabels = False))
+    figure.update_layout(xaxis = dict(zeroline = False), bargap = 0, barmode = "overlay")
+    figure.update_layout(margin=dict(l=0, r=0, t=0, b=0), showlegend = False, height = 700)
+    return figure
+
+
+#Получить график и таблицу корреляций: точки или тепловая карта плотности пар (вектор, доходность следующей свечи)
+def get_corrplot(correlation):
+    figure = go.Figure()
+    figure.update_layout(margin = dict(l = 0, r = 0, t = 0, b = 0), showlegend = False, height = 600, xaxis_title = "Вектор, %", yaxis_title = "Доходность следующей свечи, %")
+    if correlation is None: return figure, {"head": [], "body": []}
+
+    chart = correlation["chart"]
+    if "counts" in chart:
+        counts = np.where(chart["counts"] > 0, chart["counts"], np.nan)
+        figure.add_trace(go.Heatmap(
+            x = chart["x"],
+            y = chart["y"],
+            z = np.log10(counts),
+            customdata = counts,
+            colorscale = "Blues",
+            showscale = False,
+            hovertemplate = "Вектор: %{x:.4f}<br>Доходность: %{y:.4f}<br>Свечей: %{customdata:.0f}<extra></extra>",
+        ))
+    else:
+        figure.add_trace(go.Scattergl(
+            x = chart["x"],
+            y = chart["y"],
+            mode = "markers",
+            marker = dict(size = 4, opacity = 0.6, color = "#1c7ed6"),
+            hovertemplate = "Вектор: %{x:.4f}<br>Доходность: %{y:.4f}<extra></extra>",
+        ))
+
+    corr_table = {
+        "head": ["Размер вектора", "Горизонт, свечей", "Пары", "Пирсон", "Спирмен"],
+        "body": [
+            [row.vector_size, row.lag, row.pairs, f"{row.pearson:.4f}", f"{row.spearman:.4f}"]
+            for row in correlation["table"].itertuples()
+        ],
+    }
+    return figure, corr_table
+
+
 @callback(
     output = {
         "delta_info": {
@@ -406,8 +608,10 @@ def update_chart_props(chart_data, referenceLines):
             },
         },
         "price_chart_lines": Output("price_chart", "referenceLines", allow_duplicate = True),
+        "price_chart": Output("price_chart", "data", allow_duplicate = True),
         "dist_chart": Output("dist_chart", "figure"),
-        "corr_chart": Output("corr_chart", "data"),
+        "corr_chart": Output("corr_chart", "figure"),
+        "corr_table": Output("corr_table", "data"),
     },
     inputs = {
         "input": {
@@ -415,32 +619,36 @@ def update_chart_props(chart_data, referenceLines):
             "vector_vals": Input({"type": "select", "index": "vector_vals"}, "value"),
             "checkbox_states": Input({"category": "dist_chart_props", "index": ALL}, "checked"),
             "checkbox_ids": Input({"category": "dist_chart_props", "index": ALL}, "id"),
-            "price_chart_data": State("price_chart", "data"),
-            "price_chart_lines": State("price_chart", "referenceLines"),
+            "dataset_id": State("dataset_id", "data"),
             "vector_size": State("vector_size", "value"),
         }
     },
     prevent_initial_call = True
 )
+@metrics.timed("callback")
 def slider_change_processing(input):
     if not input["slider_value"]: raise PreventUpdate
+    dataset = functions.get_dataset(input["dataset_id"])
+    if dataset is None: raise PreventUpdate
+    dataset_df = dataset.df
+    stats = dataset.stats
+    slider_start, slider_end = input["slider_value"]
 
     #Подготовка данных
-    candles_df = pd.DataFrame(input["price_chart_data"])
-    candles_df = candles_df[(candles_df.index >= input["slider_value"][0]) & (candles_df.index <= input["slider_value"][1])]
+    candles_df = dataset_df.iloc[slider_start:slider_end + 1]
     checkboxes = {id["index"]: state for id, state in zip(input["checkbox_ids"], input["checkbox_states"])}
 
     if input["vector_vals"] == "positive": candles_df = candles_df.loc[candles_df["vector"] > 0]
     if input["vector_vals"] == "negative": candles_df = candles_df.loc[candles_df["vector"] < 0]
-    if checkboxes["rm_outliers"]: candles_df = functions.remove_outliers(candles_df, "vector")
+    if checkboxes["rm_outliers"]: candles_df = functions.remove_outliers(candles_df, "vector", stats.get_vector_stats(slider_start, slider_end, input["vector_vals"])["std"])
     candles_df.reset_index(inplace=True)
 
     #Информация о динамике изменения
-    start = input["price_chart_data"][input["slider_value"][0]]
-    end = input["price_chart_data"][input["slider_value"][1]]
-    date_interval = start["datetime"] + " - " + end["datetime"]
-    price_data = DeltaString(start["open"], end["open"], "₽")
-    balance_data = DeltaString(start["balance"], end["balance"], "₽")
+    start_label = functions.time_to_label(dataset_df.index[slider_start])
+    end_label = functions.time_to_label(dataset_df.index[slider_end])
+    date_interval = start_label + " - " + end_label
+    price_data = DeltaString(*stats.get_bounds("open", slider_start, slider_end), "₽")
+    balance_data = DeltaString(*stats.get_bounds("balance", slider_start, slider_end), "₽")
 
     delta_info = {
         "date_interval": date_interval,
@@ -454,51 +662,236 @@ def slider_change_processing(input):
         },
     }
 
-    #Установка границ интервала
-    referenceLines_output = [line for line in input["price_chart_lines"] if "y" in line]
-    referenceLines_output += [
-        {"x": input["price_chart_data"][input["slider_value"][0]]["datetime"]},
-        {"x": input["price_chart_data"][input["slider_value"][1]]["datetime"]}
+    #Установка границ интервала и минимума/максимума цены в нем
+    open_min, open_max = stats.get_min("open", slider_start, slider_end), stats.get_max("open", slider_start, slider_end)
+    referenceLines_output = [
+        {"y": open_min, "label": open_min},
+        {"y": open_max, "label": open_max},
+        {"x": start_label},
+        {"x": end_label}
     ]
 
-    #Получение данных для графика распределения
-    distplot = ff.create_distplot(
-        hist_data = [list(candles_df["vector"])], 
-        group_labels = ["vector"], 
-        rug_text = [list(candles_df["datetime"])], 
-        curve_type = "kde", 
-        bin_size = (candles_df["vector"].max() - candles_df["vector"].min()) / 50, 
-        show_hist = checkboxes["show_hist"],
-        show_curve = checkboxes["show_curve"],
-        show_rug = checkboxes["show_rug"],
-    )
-    distplot.update_layout(margin=dict(l=0, r=0, t=0, b=0), showlegend = False, height = 700)
-
-    #Получение данных для графика корреляции
-    vectors = functions.get_vectors(candles_df, input["vector_size"])
-    vectors = vectors[input["vector_size"] - 1: -1]
-    deltas = functions.get_vectors(candles_df, 1)
-    deltas = vectors[input["vector_size"]:]
-
-    corr_chart_data = {}
-    corr_chart_data["name"] = "Корреляция значений"
-    corr_chart_data["color"] = "blue.7"
-    corr_chart_data["data"] = [{"vector": vector, "delta": delta} for vector, delta in zip(vectors, deltas)]
+    #Прореживание графика курса с детализацией выбранного диапазона
+    if len(dataset_df) > functions.CHART_POINTS and ctx.triggered_id == "share_price_slider":
+        price_chart_data = functions.get_chart_data(dataset_df, slider_start, slider_end)
+    else: price_chart_data = dash.no_update
+
+    #Получение данных для графика распределения (кэшируется по срезу и фильтру)
+    distribution_key = (input["dataset_id"], dataset.version, slider_start, slider_end, input["vector_vals"], checkboxes["rm_outliers"])
+    distribution = functions.distribution_cache.get(distribution_key)
+    if distribution is None:
+        distribution = functions.get_distribution(candles_df["vector"].values, candles_df["time"].values)
+        functions.distribution_cache.put(distribution_key, distribution)
+    distplot = get_distplot(distribution, checkboxes["show_hist"], checkboxes["show_curve"], checkboxes["show_rug"])
+
+    #Корреляции вектора с будущей доходностью (по непрерывному срезу без фильтра значений, кэшируются по срезу)
+    correlation_key = (input["dataset_id"], dataset.version, slider_start, slider_end, input["vector_size"])
+    correlation = functions.correlation_cache.get(correlation_key)
+    if correlation is None:
+        correlation = functions.get_correlation(dataset_df, slider_start, slider_end, input["vector_size"])
+        functions.correlation_cache.put(correlation_key, correlation)
+    corrplot, corr_table = get_corrplot(correlation)
 
     #Возврат
-    session_data = json.loads(session["data"])
-    for key in checkboxes: session_data["distplot_props"][key] = checkboxes[key]
-    session["data"] = json.dumps(session_data, cls = functions.NpEncoder)
+    session_store.update_settings(sessions.get_sid(), **checkboxes)
 
     output = {}
     output["delta_info"] = delta_info
     output["price_chart_lines"] = referenceLines_output
+    output["price_chart"] = price_chart_data
     output["dist_chart"] = distplot
-    output["corr_chart"] = [corr_chart_data]
+    output["corr_chart"] = corrplot
+    output["corr_table"] = corr_table
 
     return output
 
 
+@callback(
+    Output("live_interval", "disabled"),
+    Output("live_dataset_id", "data"),
+    Output("live_version", "data"),
+
+    Input("live_switch", "checked"),
+    Input("dataset_id", "data"),
+    State("live_dataset_id", "data"),
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def set_live_mode(live, dataset_id, live_dataset_id):
+    if live_dataset_id: live_candles.unsubscribe(live_dataset_id)
+
+    #Онлайн-режим доступен только для набора данных, доходящего до текущего момента
+    dataset = functions.get_dataset(dataset_id)
+    if not (live and dataset is not None and dataset.is_actual()): return True, None, None
+    if not live_candles.subscribe(dataset_id, dataset): return True, None, None
+
+    return False, dataset_id, {"version": dataset.version, "length": len(dataset.df)}
+
+
+@callback(
+    Output("price_chart", "data", allow_duplicate = True),
+    Output("share_price_slider", "max", allow_duplicate = True),
+    Output("share_price_slider", "value", allow_duplicate = True),
+    Output("live_version", "data", allow_duplicate = True),
+
+    Input("live_interval", "n_intervals"),
+    State("live_dataset_id", "data"),
+    State("live_version", "data"),
+    State("share_price_slider", "value"),
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def update_live_chart(n_intervals, live_dataset_id, live_version, slider_value):
+    dataset = functions.get_dataset(live_dataset_id)
+    if dataset is None or not live_version: raise PreventUpdate
+
+    #Подписка, снятая за время без опросов (например, при спящей вкладке), возобновляется, если свечи не пропущены
+    if not live_candles.touch(live_dataset_id):
+        if not (dataset.is_actual() and live_candles.subscribe(live_dataset_id, dataset)): raise PreventUpdate
+
+    version, candles_df = dataset.version, dataset.df
+    if version == live_version["version"]: raise PreventUpdate
+
+    #Правая граница ползунка следует за последней свечой, если стояла на ней
+    length = live_version["length"]
+    slider_max = len(candles_df) - 1
+    chart_range = slider_value or [None, None]
+    if slider_value and slider_value[1] == length - 1: slider_value = chart_range = [slider_value[0], slider_max]
+    else: slider_value = dash.no_update
+
+    #В график дописываются только изменившаяся последняя свеча и новые свечи. Когда дописанных точек
+    #становится больше CHART_POINTS // 10, график заново прореживается, поэтому он не растет неограниченно.
+    appended = live_version.get("appended", 0) + len(candles_df) - length
+    if appended > functions.CHART_POINTS // 10:
+        price_chart_data = functions.get_chart_data(candles_df, *chart_range)
+        appended = 0
+    else:
+        records = functions.get_chart_records(candles_df, np.arange(max(length - 1, 0), len(candles_df)))
+        price_chart_data = Patch()
+        if length: price_chart_data[-1] = records.pop(0)
+        for record in records: price_chart_data.append(record)
+
+    return price_chart_data, slider_max, slider_value, {"version": version, "length": len(candles_df), "appended": appended}
+
+
+@callback(
+    Output("sweep_chart", "figure"),
+    Output("sweep_table", "data"),
+
+    Input("sweep_button", "n_clicks"),
+    State("dataset_id", "data"),
+    State("session_id", "data"),
+    background = True,
+    running = [(Output("sweep_button", "loading"), True, False)],
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def run_parameter_sweep(n_clicks, dataset_id, session_id):
+    dataset = functions.get_dataset(dataset_id)
+    if dataset is None or not len(dataset.df): raise PreventUpdate
+    candles_df = dataset.df
+
+    with jobs.job_slot(session_id): results_df = sweep.run_sweep(candles_df["open"], candles_df["close"])
+
+    #Тепловая карта: лучший баланс для каждой пары (размер вектора, процентиль)
+    best_df = results_df.loc[results_df.groupby(["vector_size", "percentile"])["balance"].idxmax()]
+    balance_map = best_df.pivot(index = "vector_size", columns = "percentile", values = "balance")
+    part_map = best_df.pivot(index = "vector_size", columns = "percentile", values = "part_of_sell_limit")
+    comission_map = best_df.pivot(index = "vector_size", columns = "percentile", values = "comission")
+
+    sweep_chart = go.Figure(
+        go.Heatmap(
+            z = balance_map.values,
+            x = [str(percentile) for percentile in balance_map.columns],
+            y = [str(vector_size) for vector_size in balance_map.index],
+            customdata = np.dstack([part_map.values, comission_map.values]),
+            colorscale = "RdYlGn",
+            hovertemplate = "Процентиль: %{x}<br>Размер вектора: %{y}<br>Баланс: %{z:.4f}<br>Доля лимита: %{customdata[0]}<br>Комиссия: %{customdata[1]}<extra></extra>",
+        )
+    )
+    sweep_chart.update_layout(margin = dict(l = 0, r = 0, t = 0, b = 0), height = 500, xaxis_title = "Процентиль", yaxis_title = "Размер вектора")
+
+    sweep_table = {
+        "head": ["Размер вектора", "Процентиль", "Доля лимита", "Комиссия", "Баланс", "Сделки", "Просадка"],
+        "body": [
+            [row.vector_size, row.percentile, row.part_of_sell_limit, row.comission, round(row.balance, 4), row.trades, f"{row.drawdown * 100:.2f}%"]
+            for row in results_df.head(50).itertuples()
+        ],
+    }
+
+    return sweep_chart, sweep_table
+
+
+@callback(
+    Output("screener_table", "data"),
+
+    Input("screener_button", "n_clicks"),
+    State({"type": "select", "index": "interval"}, "value"),
+    State({"type": "select", "index": "candle"}, "value"),
+    State("vector_size", "value"),
+    State("session_id", "data"),
+    background = True,
+    running = [(Output("screener_button", "loading"), True, False)],
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def run_share_screener(n_clicks, interval, candle, vector_size, session_id):
+    if not (interval and candle and vector_size): raise PreventUpdate
+
+    time_interval = chart_props["standard_values"][interval]["interval"]
+    candle_interval = chart_props["candle_intervals"][candle]
+    with jobs.job_slot(session_id): results_df = screener.run_screener(candle_interval, time_interval, vector_size)
+
+    return results_df.drop(columns = ["figi"]).to_dict("records")
+
+
+#Бэктест по всей истории акции (минутные свечи за годы): история догружается в файлы на диске,
+#стратегия считается блоками по всей истории и walk-forward по окнам обучения и проверки
+@callback(
+    Output("history_summary", "children"),
+    Output("history_chart", "figure"),
+    Output("history_table", "data"),
+
+    Input("history_button", "n_clicks"),
+    State({"type": "select", "index": "share"}, "value"),
+    State({"type": "select", "index": "candle"}, "value"),
+    State("vector_size", "value"),
+    State("history_train_days", "value"),
+    State("history_test_days", "value"),
+    State("session_id", "data"),
+    background = True,
+    running = [(Output("history_button", "loading"), True, False)],
+    progress = Output("history_progress", "value"),
+    progress_default = 0,
+    interval = 500,
+    prevent_initial_call = True
+)
+@metrics.timed("callback")
+def run_history_walk_forward(set_progress, n_clicks, share, candle, vector_size, train_days, test_days, session_id):
+    if not (share and candle and vector_size and train_days and test_days): raise PreventUpdate
+
+    candle_interval = chart_props["candle_intervals"][candle]
+    with jobs.job_slot(session_id):
+        #Загрузка истории - первая половина шкалы, walk-forward - вторая
+        history.sync_history(share, candle_interval, lambda value: set_progress(value // 2))
+        summary = history.run_history_backtest(share, candle_interval, vector_size)
+        windows_df = history.walk_forward(share, candle_interval, vector_size, relativedelta(days = train_days), relativedelta(days = test_days), progress = lambda value: set_progress(50 + value // 2))
+
+    history_summary = f"Вся история: свечей {summary['candles']}, баланс {summary['balance']:.4f}, сделок {summary['trades']}, просадка {summary['drawdown'] * 100:.2f}%"
+
+    windows_df["start"] = functions.times_to_labels(windows_df["start"])
+    windows_df["end"] = functions.times_to_labels(windows_df["end"])
+    history_chart = go.Figure(
+        [
+            go.Bar(x = windows_df["end"], y = windows_df["return"], name = "Доходность окна", marker_color = np.where(windows_df["return"] >= 0, "teal", "crimson")),
+            go.Scatter(x = windows_df["end"], y = windows_df["balance"], name = "Баланс", mode = "lines+markers", line = dict(color = "gray")),
+        ]
+    )
+    history_chart.update_layout(margin = dict(l = 0, r = 0, t = 0, b = 0), height = 400, legend = dict(orientation = "h"))
+
+    return history_summary, history_chart, windows_df.to_dict("records")
+
+
 @callback(
     Output({"type": "select", "index": "candle"}, "disabled"),
     Output({"type": "select", "index": "candle"}, "value", allow_duplicate = True),
@@ -508,16 +901,14 @@ def slider_change_processing(input):
     State({"type": "select", "index": "candle"}, "value"),
     prevent_initial_call = True
 )
+@metrics.timed("callback")
 def set_candle(is_standard, interval, old_candle_value):
     if not (interval and old_candle_value): raise PreventUpdate
     candle_select_disabled = is_standard
     if is_standard: new_candle_value = chart_props["standard_values"][interval]["candle"]["value"]
     else: new_candle_value = old_candle_value
 
-    session_data = json.loads(session["data"])
-    session_data["select_values"]["candle"] = new_candle_value
-    session_data["select_values"]["interval"] = interval
-    session["data"] = json.dumps(session_data, cls = functions.NpEncoder)
+    session_store.update_settings(sessions.get_sid(), candle = new_candle_value, interval = interval)
 
     return candle_select_disabled, new_candle_value
 
@@ -530,6 +921,7 @@ def set_candle(is_standard, interval, old_candle_value):
     State("info_switch", "color"),
     prevent_initial_call = True
 )
+@metrics.timed("callback")
 def change_display(click, switch_color):
     if switch_color == "blue.7":
         switch_color = "red.7"
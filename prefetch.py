@@ -0,0 +1,59 @@
+import os
+import queue
+import threading
+
+import dotenv
+
+import functions
+import metrics
+
+dotenv.load_dotenv()
+PREFETCH_QUEUE_SIZE = int(os.getenv("PREFETCH_QUEUE_SIZE", 8))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 1))
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", 600))
+PREFETCH_SESSIONS = int(os.getenv("PREFETCH_SESSIONS", 1024))
+
+
+#Упреждающий расчет наборов данных соседних окон.
+#Окна рассчитываются в потоках процесса сервера и попадают в кэш наборов данных на диске на PREFETCH_TTL секунд,
+#поэтому обратный вызов, запросивший такое окно, получает готовый набор (или ждет уже идущий расчет).
+#Очередь ограничена: окна, не поместившиеся в нее, не рассчитываются. Новый запрос пользователя отменяет его ожидающие окна.
+class Prefetcher():
+    def __init__(self, size, workers):
+        self.__queue = queue.Queue(size)
+        self.__workers = workers
+        self.__lock = threading.Lock()
+        self.__generations = functions.LRUCache(PREFETCH_SESSIONS)
+        self.__threads = []
+
+    def __run(self):
+        while True:
+            sid, generation, window = self.__queue.get()
+            try:
+                with self.__lock: is_actual = self.__generations.get(sid) == generation
+                if is_actual: functions.build_dataset(*window, ttl = PREFETCH_TTL)
+            except Exception as error:
+                metrics.registry.count_error("stage_seconds", "prefetch")
+                print(f"Упреждающий расчет окна не выполнен: {error}")
+            finally:
+                self.__queue.task_done()
+
+    #Отменить ожидающие окна пользователя (окно, которое уже рассчитывается, досчитывается)
+    def cancel(self, sid):
+        with self.__lock: self.__generations.put(sid, self.__generations.get(sid, 0) + 1)
+
+    #Поставить в очередь окна (аргументы functions.build_dataset) вместо ранее запрошенных пользователем
+    def submit(self, sid, windows):
+        with self.__lock:
+            generation = self.__generations.get(sid, 0) + 1
+            self.__generations.put(sid, generation)
+            if not self.__threads:
+                self.__threads = [threading.Thread(target = self.__run, daemon = True) for _ in range(self.__workers)]
+                for thread in self.__threads: thread.start()
+
+        for window in windows:
+            try: self.__queue.put_nowait((sid, generation, window))
+            except queue.Full: break
+
+
+prefetcher = Prefetcher(PREFETCH_QUEUE_SIZE, PREFETCH_WORKERS)
@@ -0,0 +1,258 @@
+import os
+import glob
+import time
+import pickle
+import random
+import asyncio
+import threading
+from datetime import datetime
+
+import dotenv
+import numpy as np
+import pytz
+
+from tinkoff.invest import HistoricCandle, Quotation, SharesResponse, ShareResponse
+
+dotenv.load_dotenv()
+INVEST_TRANSPORT = os.getenv("INVEST_TRANSPORT", "live")
+if INVEST_TRANSPORT not in ["live", "record", "replay"]: raise ValueError(f"Неизвестный режим INVEST_TRANSPORT: {INVEST_TRANSPORT}")
+REPLAY_DIR = os.getenv("INVEST_REPLAY_DIR", "replay")
+REPLAY_LATENCY = float(os.getenv("INVEST_REPLAY_LATENCY", 0))
+REPLAY_JITTER = float(os.getenv("INVEST_REPLAY_JITTER", 0))
+
+#Колонки записанных свечей: цены - целая часть и нано-доли, время - в миллисекундах UTC
+replay_columns = ["time", "open_units", "open_nano", "high_units", "high_nano", "low_units", "low_nano", "close_units", "close_nano", "volume", "is_complete"]
+
+
+#Записанные ответы API в каталоге path.
+#Акции - instruments.pickle, свечи - candles/<figi>_<interval>.npz (одна колонка на поле, повторная запись объединяется по времени).
+class ReplayStore():
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__instruments = None
+        self.__candles = {}
+
+    def __candles_path(self, figi, interval):
+        return os.path.join(self.__path, "candles", f"{figi}_{int(interval)}.npz")
+
+    def __load_instruments(self):
+        if self.__instruments is None:
+            path = os.path.join(self.__path, "instruments.pickle")
+            if os.path.exists(path):
+                with open(path, "rb") as file: self.__instruments = pickle.load(file)
+            else: self.__instruments = {"shares": None, "share_by": {}}
+        return self.__instruments
+
+    def __load_candles(self, figi, interval):
+        key = (figi, int(interval))
+        if key not in self.__candles:
+            path = self.__candles_path(figi, interval)
+            if os.path.exists(path):
+                with np.load(path) as data: self.__candles[key] = {column: data[column] for column in replay_columns}
+            else: self.__candles[key] = {column: np.empty(0, dtype = np.int64) for column in replay_columns}
+        return self.__candles[key]
+
+    def get_shares(self):
+        with self.__lock: return self.__load_instruments()["shares"]
+
+    def get_share(self, figi):
+        with self.__lock:
+            instruments = self.__load_instruments()
+            share = instruments["share_by"].get(figi)
+            if share is None and instruments["shares"]: share = next((share for share in instruments["shares"] if share.figi == figi), None)
+            return share
+
+    def put_shares(self, shares):
+        with self.__lock:
+            self.__load_instruments()["shares"] = list(shares)
+            self.__save_instruments()
+
+    def put_share(self, share):
+        with self.__lock:
+            self.__load_instruments()["share_by"][share.figi] = share
+            self.__save_instruments()
+
+    def __save_instruments(self):
+        os.makedirs(self.__path, exist_ok = True)
+        with open(os.path.join(self.__path, "instruments.pickle"), "wb") as file: pickle.dump(self.__instruments, file)
+
+    #Получить колонки свечей из [start_ms, end_ms)
+    def get_candles(self, figi, interval, start_ms, end_ms):
+        with self.__lock: candles = self.__load_candles(figi, interval)
+        start, end = np.searchsorted(candles["time"], [start_ms, end_ms])
+        return {column: values[start:end] for column, values in candles.items()}
+
+    def put_candles(self, figi, interval, candles):
+        if not candles: return
+        recorded = {
+            "time": [int(candle.time.astimezone(pytz.UTC).timestamp() * 1000) for candle in candles],
+            "volume": [candle.volume for candle in candles],
+            "is_complete": [int(candle.is_complete) for candle in candles],
+        }
+        for field in ["open", "high", "low", "close"]:
+            recorded[f"{field}_units"] = [getattr(candle, field).units for candle in candles]
+            recorded[f"{field}_nano"] = [getattr(candle, field).nano for candle in candles]
+
+        with self.__lock:
+            stored = self.__load_candles(figi, interval)
+            merged = {column: np.concatenate((stored[column], np.asarray(recorded[column], dtype = np.int64))) for column in replay_columns}
+
+            #Повторно записанная свеча заменяет прежнюю
+            times = merged["time"][::-1]
+            _, positions = np.unique(times, return_index = True)
+            positions = len(times) - 1 - positions
+            self.__candles[(figi, int(interval))] = {column: values[positions] for column, values in merged.items()}
+
+            os.makedirs(os.path.join(self.__path, "candles"), exist_ok = True)
+            np.savez_compressed(self.__candles_path(figi, interval), **self.__candles[(figi, int(interval))])
+
+    #Акции, для которых записаны свечи
+    def get_candle_figis(self):
+        return sorted({os.path.basename(path).rsplit("_", 1)[0] for path in glob.glob(os.path.join(self.__path, "candles", "*.npz"))})
+
+
+def get_latency():
+    return max(REPLAY_LATENCY + random.uniform(-REPLAY_JITTER, REPLAY_JITTER), 0) / 1000
+
+def to_historic_candles(candles):
+    for index in range(len(candles["time"])):
+        yield HistoricCandle(
+            open = Quotation(units = int(candles["open_units"][index]), nano = int(candles["open_nano"][index])),
+            high = Quotation(units = int(candles["high_units"][index]), nano = int(candles["high_nano"][index])),
+            low = Quotation(units = int(candles["low_units"][index]), nano = int(candles["low_nano"][index])),
+            close = Quotation(units = int(candles["close_units"][index]), nano = int(candles["close_nano"][index])),
+            volume = int(candles["volume"][index]),
+            time = datetime.fromtimestamp(candles["time"][index] / 1000, pytz.UTC),
+            is_complete = bool(candles["is_complete"][index]),
+        )
+
+def to_ms(moment):
+    return int(moment.timestamp() * 1000)
+
+
+#Запись: вызовы передаются настоящему клиенту, ответы сохраняются в хранилище
+class RecordingInstruments():
+    def __init__(self, instruments, store):
+        self.__instruments = instruments
+        self.__store = store
+
+    def shares(self, *args, **kwargs):
+        response = self.__instruments.shares(*args, **kwargs)
+        self.__store.put_shares(response.instruments)
+        return response
+
+    def share_by(self, *args, **kwargs):
+        response = self.__instruments.share_by(*args, **kwargs)
+        self.__store.put_share(response.instrument)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.__instruments, name)
+
+class RecordingServices():
+    def __init__(self, services, store):
+        self.__services = services
+        self.__store = store
+        self.instruments = RecordingInstruments(services.instruments, store)
+
+    def get_all_candles(self, **kwargs):
+        candles = []
+        for candle in self.__services.get_all_candles(**kwargs):
+            candles.append(candle)
+            yield candle
+        self.__store.put_candles(kwargs["figi"], kwargs["interval"], candles)
+
+    def __getattr__(self, name):
+        return getattr(self.__services, name)
+
+#Асинхронный клиент используется только для загрузки свечей
+class AsyncRecordingServices():
+    def __init__(self, services, store):
+        self.__services = services
+        self.__store = store
+
+    async def get_all_candles(self, **kwargs):
+        candles = []
+        async for candle in self.__services.get_all_candles(**kwargs):
+            candles.append(candle)
+            yield candle
+        self.__store.put_candles(kwargs["figi"], kwargs["interval"], candles)
+
+    def __getattr__(self, name):
+        return getattr(self.__services, name)
+
+
+#Воспроизведение: ответы берутся из хранилища с задержкой get_latency() на вызов
+class ReplayInstruments():
+    def __init__(self, store):
+        self.__store = store
+
+    def shares(self, *args, **kwargs):
+        time.sleep(get_latency())
+        shares = self.__store.get_shares()
+        if shares is None: raise LookupError("Список акций не записан")
+        return SharesResponse(instruments = shares)
+
+    def share_by(self, id_type = None, class_code = "", id = "", **kwargs):
+        time.sleep(get_latency())
+        share = self.__store.get_share(id)
+        if share is None: raise LookupError(f"Акция {id} не записана")
+        return ShareResponse(instrument = share)
+
+class ReplayServices():
+    def __init__(self, store):
+        self.__store = store
+        self.instruments = ReplayInstruments(store)
+
+    def get_all_candles(self, figi = "", from_ = None, to = None, interval = None, **kwargs):
+        time.sleep(get_latency())
+        to = to or datetime.now(pytz.UTC)
+        return to_historic_candles(self.__store.get_candles(figi, interval, to_ms(from_), to_ms(to)))
+
+class AsyncReplayServices():
+    def __init__(self, store):
+        self.__store = store
+
+    async def get_all_candles(self, figi = "", from_ = None, to = None, interval = None, **kwargs):
+        await asyncio.sleep(get_latency())
+        to = to or datetime.now(pytz.UTC)
+        for candle in to_historic_candles(self.__store.get_candles(figi, interval, to_ms(from_), to_ms(to))):
+            yield candle
+
+
+replay_store = ReplayStore(REPLAY_DIR)
+
+#Получить класс клиента для режима INVEST_TRANSPORT: live - client_class без изменений, record - запись ответов, replay - воспроизведение
+def get_client(client_class):
+    if INVEST_TRANSPORT == "live": return client_class
+
+    class TransportClient():
+        def __init__(self, token, target = None, **kwargs):
+            self.__client = client_class(token, target = target, **kwargs) if INVEST_TRANSPORT == "record" else None
+
+        def __enter__(self):
+            if self.__client is None: return ReplayServices(replay_store)
+            return RecordingServices(self.__client.__enter__(), replay_store)
+
+        def __exit__(self, *args):
+            if self.__client is not None: return self.__client.__exit__(*args)
+
+    return TransportClient
+
+#Асинхронный вариант get_client для tinkoff.invest.AsyncClient
+def get_async_client(client_class):
+    if INVEST_TRANSPORT == "live": return client_class
+
+    class AsyncTransportClient():
+        def __init__(self, token, target = None, **kwargs):
+            self.__client = client_class(token, target = target, **kwargs) if INVEST_TRANSPORT == "record" else None
+
+        async def __aenter__(self):
+            if self.__client is None: return AsyncReplayServices(replay_store)
+            return AsyncRecordingServices(await self.__client.__aenter__(), replay_store)
+
+        async def __aexit__(self, *args):
+            if self.__client is not None: return await self.__client.__aexit__(*args)
+
+    return AsyncTransportClient
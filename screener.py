@@ -0,0 +1,92 @@
+import os
+import asyncio
+import itertools
+from datetime import datetime
+
+import dotenv
+import grpc
+import pytz
+import pandas as pd
+
+from tinkoff.invest import AsyncClient
+from tinkoff.invest.exceptions import AioRequestError, RequestError
+
+import replay
+import functions
+import metrics
+from candle_store import candle_store
+
+dotenv.load_dotenv()
+TOKEN = os.getenv("INVEST_TOKEN")
+SCREENER_CONCURRENCY = int(os.getenv("SCREENER_CONCURRENCY", 8))
+SCREENER_RETRIES = int(os.getenv("SCREENER_RETRIES", 5))
+SCREENER_BACKOFF = float(os.getenv("SCREENER_BACKOFF", 1))
+
+AsyncClient = replay.get_async_client(AsyncClient)
+
+
+#Загрузить свечи промежутка. При превышении лимита запросов (RESOURCE_EXHAUSTED) запрос повторяется
+#не более retries раз с экспоненциально растущей задержкой.
+async def get_all_candles(client, figi, candle_interval, from_, to, retries = SCREENER_RETRIES, backoff = SCREENER_BACKOFF):
+    for attempt in itertools.count():
+        try: return [candle async for candle in client.get_all_candles(figi=figi, from_=from_, to=to, interval=candle_interval)]
+        except (AioRequestError, RequestError) as error:
+            if error.code != grpc.StatusCode.RESOURCE_EXHAUSTED or attempt >= retries: raise
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+#Загрузить недостающие свечи акции через асинхронный клиент (не более concurrency загрузок одновременно)
+async def fill_candle_gaps(client, semaphore, figi, candle_interval, start_ms, end_ms):
+    gaps = functions.derive_candle_gaps(figi, candle_interval, candle_store.get_gaps(figi, candle_interval, start_ms, end_ms))
+    for gap_start, gap_end in gaps:
+        async with semaphore:
+            from_ = datetime.fromtimestamp(gap_start / 1000, pytz.UTC)
+            to = datetime.fromtimestamp(gap_end / 1000, pytz.UTC)
+            candles = await get_all_candles(client, figi, candle_interval, from_, to)
+        functions.store_candles(figi, candle_interval, candles, gap_start, gap_end)
+
+#Прогнать стратегию по одной акции
+async def screen_share(client, semaphore, figi, candle_interval, start_ms, end_ms, vector_size):
+    await fill_candle_gaps(client, semaphore, figi, candle_interval, start_ms, end_ms)
+    candles_df = candle_store.load(figi, candle_interval, start_ms, end_ms)
+
+    vectors = functions.calc_vectors(candles_df["open"], candles_df["close"], [vector_size])[vector_size]
+    if not (vectors > 0).any(): return {"figi": figi, "candles": len(candles_df), "balance": 1.0, "trades": 0, "drawdown": 0.0}
+
+    balance_history, status = functions.run_strategy(candles_df["open"], candles_df["close"], vectors, functions.get_purchase_coef_limit(vectors), 0, 0.0003)
+    return {"figi": figi, "candles": len(candles_df), **functions.get_strategy_summary(balance_history, status)}
+
+async def screen_shares(figis, candle_interval, start_ms, end_ms, vector_size, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncClient(TOKEN, target = functions.INVEST_TARGET) as client:
+        return await asyncio.gather(
+            *[screen_share(client, semaphore, figi, candle_interval, start_ms, end_ms, vector_size) for figi in figis],
+            return_exceptions = True
+        )
+
+#Текст ошибки акции для таблицы скринера
+def get_error_text(error):
+    if isinstance(error, (AioRequestError, RequestError)): return f"{error.code.name}: {error.details}"
+    return str(error) or type(error).__name__
+
+#Прогнать стратегию по всем доступным акциям за период time_interval до текущего момента.
+#Возвращает таблицу с конечным балансом, количеством сделок и просадкой; для акций, по которым произошла ошибка,
+#вместо итогов заполняется текст ошибки (такие строки идут в конце).
+def run_screener(candle_interval, time_interval, vector_size, concurrency = SCREENER_CONCURRENCY):
+    shares_df = functions.get_available_shares()
+
+    end_datetime = datetime.now(pytz.UTC)
+    start_ms = int((end_datetime - time_interval).timestamp() * 1000)
+    end_ms = int(end_datetime.timestamp() * 1000)
+
+    figis = list(shares_df["figi"])
+    results = asyncio.run(screen_shares(figis, candle_interval, start_ms, end_ms, vector_size, concurrency))
+    for index, (figi, result) in enumerate(zip(figis, results)):
+        if not isinstance(result, Exception): continue
+        metrics.registry.count_error("stage_seconds", "screen_share")
+        results[index] = {"figi": figi, "error": get_error_text(result)}
+
+    results_df = pd.DataFrame(results, columns = ["figi", "candles", "balance", "trades", "drawdown", "error"])
+    results_df = shares_df[["figi", "ticker", "name"]].merge(results_df, on = "figi")
+    results_df = results_df.sort_values("balance", ascending = False, ignore_index = True)
+
+    return results_df
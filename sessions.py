@@ -0,0 +1,107 @@
+import os
+import json
+import uuid
+import atexit
+import sqlite3
+import threading
+import dataclasses
+from collections import OrderedDict
+
+import dotenv
+from flask import session
+
+dotenv.load_dotenv()
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", 1024))
+SESSION_SPILL_PATH = os.getenv("SESSION_SPILL_PATH")
+
+
+#Настройки пользователя на странице аналитики
+@dataclasses.dataclass
+class Settings():
+    share: str = None
+    interval: str = "1m"
+    candle: str = "30m"
+    vector_vals: str = "all"
+    vector_size: int = 1
+    rm_outliers: bool = False
+    show_hist: bool = True
+    show_curve: bool = True
+    show_rug: bool = True
+    standard_candles: bool = True
+
+settings_types = {field.name: field.type for field in dataclasses.fields(Settings)}
+settings_defaults = {field.name: field.default for field in dataclasses.fields(Settings)}
+
+
+#Данные сессии: настройки (сохраняются в SQLite при вытеснении)
+class SessionData():
+    def __init__(self, settings = None):
+        self.settings = settings or Settings()
+
+
+#Серверное хранилище сессий: LRU в памяти, вытесненные настройки при заданном spill_path сохраняются в SQLite.
+#Изменения делаются по полям под блокировкой, поэтому параллельные обратные вызовы не затирают настройки друг друга.
+class SessionStore():
+    def __init__(self, size, spill_path = None):
+        self.__size = size
+        self.__lock = threading.Lock()
+        self.__sessions = OrderedDict()
+        self.__connection = None
+        if spill_path:
+            self.__connection = sqlite3.connect(spill_path, check_same_thread = False)
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, settings TEXT NOT NULL)")
+            self.__connection.commit()
+
+    def __spill(self, items):
+        if self.__connection is None or not items: return
+        with self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO sessions (sid, settings) VALUES (?, ?)",
+                [(sid, json.dumps(dataclasses.asdict(data.settings))) for sid, data in items]
+            )
+
+    #Получить данные сессии (вызывается под блокировкой)
+    def __get(self, sid):
+        data = self.__sessions.get(sid)
+        if data is not None:
+            self.__sessions.move_to_end(sid)
+            return data
+
+        data = SessionData()
+        if self.__connection is not None:
+            row = self.__connection.execute("SELECT settings FROM sessions WHERE sid = ?", (sid,)).fetchone()
+            if row is not None: data = SessionData(Settings(**json.loads(row[0])))
+
+        self.__sessions[sid] = data
+        evicted = []
+        while len(self.__sessions) > self.__size: evicted.append(self.__sessions.popitem(last = False))
+        self.__spill(evicted)
+        return data
+
+    #Изменить отдельные поля настроек (значения приводятся к типам полей, пустые заменяются значениями по умолчанию)
+    def update_settings(self, sid, **fields):
+        with self.__lock:
+            data = self.__get(sid)
+            for name, value in fields.items():
+                if name not in settings_types: raise AttributeError(f"Неизвестная настройка: {name}")
+                if value is None or value == "": value = settings_defaults[name]
+                setattr(data.settings, name, None if value is None else settings_types[name](value))
+            return dataclasses.replace(data.settings)
+
+    #Сбросить настройки к значениям по умолчанию
+    def reset_settings(self, sid, **fields):
+        with self.__lock: self.__get(sid).settings = Settings()
+        return self.update_settings(sid, **fields)
+
+    #Сохранить настройки всех сессий из памяти (при остановке процесса)
+    def flush(self):
+        with self.__lock: self.__spill(list(self.__sessions.items()))
+
+
+session_store = SessionStore(SESSION_STORE_SIZE, SESSION_SPILL_PATH)
+atexit.register(session_store.flush)
+
+#Идентификатор сессии текущего пользователя: в cookie хранится только он
+def get_sid():
+    if "sid" not in session: session["sid"] = uuid.uuid4().hex
+    return session["sid"]
@@ -0,0 +1,96 @@
+import os
+import uuid
+import itertools
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import dotenv
+import numpy as np
+import pandas as pd
+import psutil
+
+import functions
+
+dotenv.load_dotenv()
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", os.cpu_count() or 1))
+SHM_DIR = "/dev/shm"
+SHM_PREFIX = "t_investments_sweep_"
+
+#Сетка параметров стратегии по умолчанию
+sweep_grid = {
+    "percentile": [50, 60, 70, 75, 80, 85, 90, 95, 97.5, 99],
+    "part_of_sell_limit": [0, 0.1, 0.25, 0.5, 0.75, 1],
+    "comission": [0.0003, 0.0005, 0.001],
+    "vector_size": [1, 2, 3, 4, 5, 7, 10],
+}
+
+#Массивы свечей процесса-обработчика (только чтение, из разделяемой памяти)
+worker_arrays = {}
+
+
+#Удалить сегменты разделяемой памяти перебора, оставшиеся от завершенных процессов (например, убитой фоновой задачи).
+#Имя сегмента содержит pid создавшего его процесса.
+def remove_stale_segments():
+    if not os.path.isdir(SHM_DIR): return
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(SHM_PREFIX): continue
+        pid = name[len(SHM_PREFIX):].split("_")[0]
+        if pid.isdigit() and psutil.pid_exists(int(pid)): continue
+        try: os.unlink(os.path.join(SHM_DIR, name))
+        except FileNotFoundError: pass
+
+#Подключить процесс-обработчик к разделяемой памяти со свечами
+def attach_worker(shm_name, size):
+    shm = shared_memory.SharedMemory(name = shm_name)
+    candles = np.ndarray((2, size), dtype = np.float64, buffer = shm.buf)
+    candles.flags.writeable = False
+
+    worker_arrays["shm"] = shm
+    worker_arrays["opens"] = candles[0]
+    worker_arrays["closes"] = candles[1]
+
+#Прогнать стратегию для одного размера вектора и набора (процентиль, доля лимита, комиссия)
+def run_sweep_task(vector_size, combinations):
+    opens, closes = worker_arrays["opens"], worker_arrays["closes"]
+    vectors = functions.calc_vectors(opens, closes, [vector_size])[vector_size]
+    positive_vectors = vectors[vectors > 0]
+
+    results = []
+    for percentile, part_of_sell_limit, comission in combinations:
+        purchase_coef_limit = np.percentile(positive_vectors, percentile) if len(positive_vectors) else np.inf
+        balance_history, status = functions.run_strategy(opens, closes, vectors, purchase_coef_limit, part_of_sell_limit, comission)
+
+        result = {"vector_size": vector_size, "percentile": percentile, "part_of_sell_limit": part_of_sell_limit, "comission": comission}
+        result.update(functions.get_strategy_summary(balance_history, status))
+        results.append(result)
+
+    return results
+
+#Перебрать параметры стратегии на одних и тех же свечах.
+#Свечи один раз копируются в разделяемую память (сегменты убитых запусков удаляются при следующем), задачи (размер вектора, часть комбинаций) распределяются по процессам.
+#Возвращает таблицу результатов, отсортированную по конечному балансу.
+def run_sweep(opens, closes, grid = sweep_grid, workers = SWEEP_WORKERS, batch_size = 32):
+    opens = np.asarray(opens, dtype = np.float64)
+    closes = np.asarray(closes, dtype = np.float64)
+
+    combinations = list(itertools.product(grid["percentile"], grid["part_of_sell_limit"], grid["comission"]))
+    tasks = [(vector_size, combinations[index:index + batch_size]) for vector_size in grid["vector_size"] for index in range(0, len(combinations), batch_size)]
+
+    remove_stale_segments()
+    shm = shared_memory.SharedMemory(name = f"{SHM_PREFIX}{os.getpid()}_{uuid.uuid4().hex[:8]}", create = True, size = max(1, 2 * len(opens) * 8))
+    try:
+        candles = np.ndarray((2, len(opens)), dtype = np.float64, buffer = shm.buf)
+        candles[0] = opens
+        candles[1] = closes
+
+        with ProcessPoolExecutor(max_workers = workers, initializer = attach_worker, initargs = (shm.name, len(opens))) as executor:
+            futures = [executor.submit(run_sweep_task, vector_size, task_combinations) for vector_size, task_combinations in tasks]
+            results = [result for future in futures for result in future.result()]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results_df = pd.DataFrame(results)
+    results_df = results_df.sort_values(["balance", "drawdown"], ascending = [False, True], ignore_index = True)
+
+    return results_df
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+#Модули приложения импортируются из корня репозитория, кэши и хранилище свечей создаются во временном каталоге
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TEST_DIR = tempfile.mkdtemp(prefix = "tests_")
+os.environ.setdefault("CANDLE_STORE_PATH", os.path.join(TEST_DIR, "candles.db"))
+os.environ.setdefault("DATASET_DISK_DIR", os.path.join(TEST_DIR, "datasets"))
+os.environ.setdefault("JOB_CACHE_DIR", os.path.join(TEST_DIR, "jobs"))
+os.environ.setdefault("METRICS_SPOOL_DIR", os.path.join(TEST_DIR, "metrics"))
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("tinkoff.invest")
+
+import functions
+
+
+@pytest.fixture(scope = "module")
+def candles_df():
+    generator = np.random.default_rng(0)
+    size = 1000000
+    return pd.DataFrame({
+        "open": 100 * np.exp(np.cumsum(generator.normal(0, 0.002, size))),
+        "balance": 1 + np.cumsum(generator.normal(0, 0.001, size)),
+    })
+
+#Выборка не превышает points точек (плюс границы коротких внешних частей) для диапазона в начале, середине и конце
+@pytest.mark.parametrize("start, end", [(0, 5000), (15000, 20000), (500000, 505000), (994999, 999999), (3, 999990), (None, None)])
+def test_chart_indexes_within_points(candles_df, start, end):
+    indexes = functions.get_chart_indexes(candles_df, functions.CHART_POINTS, start, end)
+
+    assert len(indexes) <= functions.CHART_POINTS + 4
+    assert np.all(np.diff(indexes) > 0)
+    assert indexes[0] == 0 and indexes[-1] == len(candles_df) - 1
+    if start is not None: assert start in indexes and end in indexes
@@ -0,0 +1,88 @@
+import time
+import threading
+from types import SimpleNamespace
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+
+pytest.importorskip("tinkoff.invest")
+
+from tinkoff.invest import CandleInterval, Quotation, SubscriptionInterval
+
+import functions
+import live
+
+
+#Поток рыночных данных: отдает свечи после release() и затем ждет завершения теста
+class FakeStream():
+    def __init__(self, candles):
+        self.candles = SimpleNamespace(subscribe = lambda instruments: None, unsubscribe = lambda instruments: None)
+        self.released = threading.Event()
+        self.__candles = candles
+
+    def __iter__(self):
+        self.released.wait()
+        for candle in self.__candles: yield SimpleNamespace(candle = candle)
+        threading.Event().wait()
+
+class FakeClientPool():
+    def __init__(self, stream):
+        self.__stream = stream
+
+    @contextmanager
+    def client(self):
+        yield SimpleNamespace(create_market_data_stream = lambda: self.__stream)
+
+def get_quotation(value):
+    return Quotation(units = int(value), nano = int(round((value - int(value)) * 1e9)))
+
+def get_dataset(size):
+    times = 1700000000000 + np.arange(size) * 60000
+    candles_df = pd.DataFrame({"open": np.linspace(100, 101, size), "close": np.linspace(100.1, 101.1, size), "high": 102.0, "low": 99.0, "volume": 1}, index = pd.Index(times, name = "time"))
+    return functions.Dataset("FIGI", CandleInterval.CANDLE_INTERVAL_1_MIN, int(times[-1]) + 60000, 2, candles_df)
+
+
+#Подписанный набор данных остается доступным после вытеснения из кэша, свечи из потока видны в нем
+def test_streamed_candles_visible_after_eviction(monkeypatch):
+    dataset = get_dataset(10)
+    dataset_id = functions.put_dataset(dataset)
+    next_ms = int(dataset.df.index[-1]) + 60000
+    candle = SimpleNamespace(
+        figi = "FIGI",
+        interval = SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE,
+        time = datetime.fromtimestamp(next_ms / 1000, pytz.UTC),
+        open = get_quotation(101.5), high = get_quotation(102.0), low = get_quotation(101.0), close = get_quotation(101.75),
+        volume = 3,
+    )
+    stream = FakeStream([candle])
+    monkeypatch.setattr(functions, "client_pool", FakeClientPool(stream))
+
+    live_candles = live.LiveCandles(reconnect_delay = 60)
+    assert live_candles.subscribe(dataset_id, dataset)
+    for index in range(functions.DATASET_CACHE_SIZE): functions.dataset_cache.put(f"other_{index}", None)
+    stream.released.set()
+
+    deadline = time.monotonic() + 5
+    while functions.get_dataset(dataset_id).version == 0 and time.monotonic() < deadline: time.sleep(0.01)
+
+    streamed = functions.get_dataset(dataset_id)
+    assert streamed is dataset
+    assert streamed.df.index[-1] == next_ms
+    assert streamed.df["close"].iloc[-1] == pytest.approx(101.75)
+    assert streamed.end_ms == next_ms + 60000
+
+    live_candles.unsubscribe(dataset_id)
+    assert functions.get_dataset(dataset_id) is not dataset
+
+#При воспроизведении записанных ответов поток свечей не запускается
+def test_no_subscription_in_replay(monkeypatch):
+    monkeypatch.setattr(live.replay, "INVEST_TRANSPORT", "replay")
+    live_candles = live.LiveCandles()
+    dataset = get_dataset(10)
+
+    assert not live_candles.subscribe(functions.put_dataset(dataset), dataset)
+    assert not live_candles.touch("missing")
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("tinkoff.invest")
+
+import functions
+
+purchase_percentiles = [50, 90, 99]
+parts_of_sell_limit = [0, 0.25, 1]
+comissions = [0, 0.0003, 0.001]
+
+
+#Исходный расчет баланса построчным обходом свечей (до перехода на массивы), дополненный подсчетом сделок
+def get_reference_balance_history(candles_df, purchase_coef_limit, part_of_sell_limit, comission):
+    status = {"broker": True, "purchase_price": None, "growth_coef": None, "sell_coef_limit": None, "trades": 0}
+
+    balance_history = []
+    for index, candle in candles_df.iterrows():
+        if status["broker"]:
+            balance = balance_history[index - 1] if index > 0 else 1
+
+            if candle["vector"] > purchase_coef_limit:
+                status["purchase_price"] = candle["close"]
+                status["growth_coef"] = 0
+                status["sell_coef_limit"] = functions.get_sell_coef_limit(comission, status["growth_coef"])
+                status["broker"] = False
+                status["trades"] += 1
+                balance -= balance * comission
+        else:
+            balance += candle["close"] / candle["open"] - 1
+
+            max_price = status["purchase_price"] * (1 + status["growth_coef"])
+            if candle["close"] > max_price:
+                status["growth_coef"] = functions.get_growth_coef(status["purchase_price"], candle["close"])
+                status["sell_coef_limit"] = functions.get_sell_coef_limit(comission, status["growth_coef"]) * part_of_sell_limit
+            else:
+                sell_coef = 1 - candle["close"] / max_price
+                if sell_coef > status["sell_coef_limit"]:
+                    status["broker"] = True
+                    balance -= balance * comission
+
+        balance_history.append(balance)
+
+    return balance_history, status
+
+#Случайные свечи: цена открытия - случайное блуждание со сносом drift, закрытие отличается от открытия на шум
+def get_random_candles(seed, size, drift, vector_size = 5):
+    generator = np.random.default_rng(seed)
+    opens = 100 * np.exp(np.cumsum(generator.normal(drift, 0.002, size)))
+    closes = opens * (1 + generator.normal(drift, 0.003, size))
+    candles_df = pd.DataFrame({"open": opens, "close": closes})
+    candles_df["vector"] = functions.get_vectors(candles_df, vector_size)
+    return candles_df
+
+def assert_same_status(status, reference_status, balance):
+    assert status["broker"] == reference_status["broker"]
+    assert status["trades"] == reference_status["trades"]
+    assert status["balance"] == pytest.approx(balance, rel = 1e-12)
+    for name in ["purchase_price", "growth_coef", "sell_coef_limit"]:
+        if reference_status[name] is None: assert status[name] is None
+        else: assert status[name] == pytest.approx(reference_status[name], rel = 1e-12, abs = 1e-15)
+
+
+@pytest.mark.parametrize("seed, drift", [(0, 0), (1, 0.0005), (2, -0.0005)])
+@pytest.mark.parametrize("part_of_sell_limit", parts_of_sell_limit)
+@pytest.mark.parametrize("comission", comissions)
+def test_run_strategy_matches_reference(seed, drift, part_of_sell_limit, comission):
+    candles_df = get_random_candles(seed, 1500, drift)
+    vectors = candles_df["vector"].values
+
+    for percentile in purchase_percentiles:
+        purchase_coef_limit = functions.get_purchase_coef_limit(vectors, percentile)
+        reference_history, reference_status = get_reference_balance_history(candles_df, purchase_coef_limit, part_of_sell_limit, comission)
+        balance_history, status = functions.run_strategy(candles_df["open"], candles_df["close"], vectors, purchase_coef_limit, part_of_sell_limit, comission)
+
+        np.testing.assert_allclose(balance_history, reference_history, rtol = 1e-12)
+        assert_same_status(status, reference_status, reference_history[-1])
+
+#Прогон по частям с переносом состояния совпадает с прогоном целиком
+@pytest.mark.parametrize("part_of_sell_limit", parts_of_sell_limit)
+def test_run_strategy_continues_from_status(part_of_sell_limit):
+    candles_df = get_random_candles(3, 1500, 0.0005)
+    opens, closes, vectors = candles_df["open"].values, candles_df["close"].values, candles_df["vector"].values
+    purchase_coef_limit = functions.get_purchase_coef_limit(vectors, 90)
+    reference_history, reference_status = get_reference_balance_history(candles_df, purchase_coef_limit, part_of_sell_limit, 0.0003)
+
+    status, histories = None, []
+    for start in range(0, len(candles_df), 137):
+        stop = start + 137
+        balance_history, status = functions.run_strategy(opens[start:stop], closes[start:stop], vectors[start:stop], purchase_coef_limit, part_of_sell_limit, 0.0003, status)
+        histories.append(balance_history)
+
+    np.testing.assert_allclose(np.concatenate(histories), reference_history, rtol = 1e-12)
+    assert_same_status(status, reference_status, reference_history[-1])